@@ -0,0 +1,51 @@
+"""内存准入：解码与重计算前按估算字节数申请全服务共享的内存配额。
+
+配额不足时排队等待，等待超时或单个任务超过总配额时抛出 AdmissionRejected。
+"""
+import contextlib
+import threading
+
+from instrument import prometheus_text
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class MemoryBudget:
+    """按估算字节数发放租约；配额不足时排队等待，超时或单个任务超过总配额时拒绝"""
+    def __init__(self, max_bytes, wait=60.0):
+        self.max_bytes, self.wait, self.used = max_bytes, wait, 0
+        self.counters = {'admitted': 0, 'queued': 0, 'downscaled': 0, 'rejected': 0}
+        self._cond = threading.Condition()
+
+    def count(self, name):
+        with self._cond: self.counters[name] += 1
+
+    @contextlib.contextmanager
+    def lease(self, nbytes, what, timeout=None, on_wait=None):
+        if timeout is None: timeout = self.wait
+        if nbytes > self.max_bytes:
+            self.count('rejected')
+            raise AdmissionRejected(f"{what}预计需要 {nbytes / 2**20:.0f} MB 内存，超过服务器上限 {self.max_bytes / 2**20:.0f} MB")
+        with self._cond: fits = self.used + nbytes <= self.max_bytes
+        if not fits and on_wait: on_wait()
+        with self._cond:
+            if self.used + nbytes > self.max_bytes:
+                self.counters['queued'] += 1
+                if not self._cond.wait_for(lambda: self.used + nbytes <= self.max_bytes, timeout):
+                    self.counters['rejected'] += 1
+                    raise AdmissionRejected(f"服务器繁忙，{what}排队 {timeout:.0f} 秒仍未获得内存配额，请稍后重试")
+            self.used += nbytes
+            self.counters['admitted'] += 1
+        try: yield
+        finally:
+            with self._cond:
+                self.used -= nbytes
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond: return dict(self.counters, used_bytes=self.used, max_bytes=self.max_bytes)
+
+    def prometheus_text(self):
+        return prometheus_text('admission', self.stats(), self.counters)
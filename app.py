@@ -3,17 +3,40 @@ import uuid
 import os
 import math
 import base64
+import bisect
+import functools
+import hashlib
 import json
-from PIL import Image, ImageDraw, ImageEnhance, ImageFilter, ImageOps
+from PIL import Image, ImageDraw
 import io
-import zipfile
+import tempfile
+import threading
+import urllib.parse
+from collections import Counter
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from streamlit_image_coordinates import streamlit_image_coordinates
 from streamlit_image_comparison import image_comparison
 from streamlit_drawable_canvas import st_canvas
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import canvas_render
+import image_core
+import image_export
+import instrument
+import jobs
+from admission import AdmissionRejected, MemoryBudget
+from caches import (ArchiveCache, CanvasAssetStore, DecodedImageCache, EncodedRegistry, MemoCache,
+                    PyramidRegistry)
+from result_store import SessionResultStore, StoredImage
+from instrument import span, traced
+from image_core import (STREAM_PREVIEW_SIZE, TRANSPOSE_FOR_ROTATE, PNGStreamWriter, StreamedStitch, build_crops_zip,
+                        decode_image_bytes, guide_boxes, parse_color, stitch_images_advanced, stitch_images_streaming,
+                        stitch_layout)
 
 # === 页面配置 ===
 st.set_page_config(page_title="图片工具箱 Pro Max", layout="wide", page_icon="🛠️")
 Image.MAX_IMAGE_PIXELS = None
+_rerun_spans = instrument.start()
 
 # === CSS 样式 ===
 st.markdown("""
@@ -42,143 +65,635 @@ if 'saved_rects' not in st.session_state: st.session_state['saved_rects'] = []
 if 'frozen_drawing' not in st.session_state: st.session_state['frozen_drawing'] = None
 if 'last_draw_mode' not in st.session_state: st.session_state['last_draw_mode'] = "✏️ 画框模式"
 
-# === 工具函数 ===
+# === 解码结果缓存：按内容哈希共享，按解码后字节数做 LRU 淘汰，可选落盘 ===
+DECODE_CACHE_MB = int(os.environ.get('IMAGE_TOOL_DECODE_CACHE_MB', '1024'))
+DECODE_SPILL_DIR = os.environ.get('IMAGE_TOOL_DECODE_SPILL_DIR') or None
+DECODE_SPILL_MB = int(os.environ.get('IMAGE_TOOL_DECODE_SPILL_MB', '8192'))
+METRICS_FILE = os.environ.get('IMAGE_TOOL_METRICS_FILE') or None
 
-def convert_image_to_bytes(img, fmt='PNG'):
-    buf = io.BytesIO()
-    if fmt.upper() in ['JPEG', 'JPG']: img.save(buf, format=fmt, quality=100, subsampling=0)
-    else: img.save(buf, format=fmt)
-    return buf.getvalue()
+@st.cache_resource(show_spinner=False)
+def get_decoded_cache():
+    return DecodedImageCache(DECODE_CACHE_MB * 1024 * 1024, DECODE_SPILL_DIR, DECODE_SPILL_MB * 1024 * 1024)
 
-def image_to_base64(img):
-    """将PIL图片转换为Base64字符串"""
-    buffered = io.BytesIO()
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return f"data:image/png;base64,{img_str}"
+def process_uploaded_image(uploaded_file, draft_size=None, key=None):
+    return image_core.process_uploaded_image(uploaded_file, draft_size, cache=get_decoded_cache(), decoder=admitted_decode, key=key)
 
-@st.cache_data(show_spinner=False)
-def process_uploaded_image(uploaded_file):
+def clean_image(uploaded_file):
+    """单张上传的解码；准入被拒时给出提示并返回 None，调用方结束当前工具页即可，不影响其他标签页"""
+    try: return process_uploaded_image(uploaded_file, key=upload_key(uploaded_file))
+    except AdmissionRejected as e:
+        st.error(f"🚫 {e}")
+        return None
+
+# === 准入控制：解码前只读文件头估算内存，全服务共享的内存配额决定放行、排队、入库缩小或拒绝 ===
+MEMORY_BUDGET_MB = int(os.environ.get('IMAGE_TOOL_MEMORY_BUDGET_MB', '2048'))
+INGEST_MAX_MP = int(os.environ.get('IMAGE_TOOL_INGEST_MAX_MP', '150'))  # 超过该像素数的上传在入库时缩小
+ADMIT_WAIT_S = float(os.environ.get('IMAGE_TOOL_ADMIT_WAIT_S', '60'))
+
+@st.cache_resource(show_spinner=False)
+def get_memory_budget():
+    return MemoryBudget(MEMORY_BUDGET_MB * 1024 * 1024, ADMIT_WAIT_S)
+
+def notify(message):
+    """后台任务里写到任务状态上，脚本线程里弹出 toast"""
+    job = jobs.current()
+    if job is not None: job.message = message
+    else: st.toast(message)
+
+def _notify_wait(what):
+    return lambda: notify(f"⏳ 服务器繁忙，{what}正在排队等待内存配额…")
+
+def admitted_decode(data, draft_size=None):
+    """带准入控制的 decode_image_bytes：超大图入库时缩小到 INGEST_MAX_MP 以内"""
+    try: probe = image_core.probe_image(data)
+    except Exception: return decode_image_bytes(data, draft_size)  # 无法识别的文件按原逻辑返回占位图
+    budget = get_memory_budget()
+    pixels, limit = probe.width * probe.height, INGEST_MAX_MP * 1_000_000
+    if pixels > limit:
+        ratio = math.sqrt(limit / pixels)
+        target = (max(1, int(probe.width * ratio)), max(1, int(probe.height * ratio)))
+        if not draft_size or draft_size[0] * draft_size[1] > target[0] * target[1]:
+            draft_size = target
+            budget.count('downscaled')
+            notify(f"图片过大（{probe.width} x {probe.height}），已缩小到约 {target[0]} x {target[1]} 载入")
+    what = f"解码 {probe.width} x {probe.height} 图片"
+    with budget.lease(image_core.estimate_decode_bytes(probe, draft_size), what, on_wait=_notify_wait(what)):
+        return decode_image_bytes(data, draft_size)
+
+def admit_job(what, nbytes):
+    """重计算（拼接、修复）的内存租约"""
+    return get_memory_budget().lease(nbytes, what, on_wait=_notify_wait(what))
+
+# === 预览金字塔：每张图只用 reduce() 构建一次 2 的幂次级别，预览从最近的级别做小幅缩放 ===
+THUMB_SIZE = (480, 480)
+
+@st.cache_resource(show_spinner=False)
+def get_pyramid_registry():
+    return PyramidRegistry()
+
+@traced('resize')
+def preview_of(img, size):
+    """取得 img 缩放到 size 的预览图（新对象，可以在上面绘制）"""
+    return get_pyramid_registry().get(img).get(size)
+
+def shared_preview_of(img, size):
+    """同 preview_of，但不复制：尺寸相同时返回原图或金字塔级别本身，调用方只能读取"""
+    return get_pyramid_registry().get(img).get(size, shared=True)
+
+def fit_size(size, max_w, max_h=None):
+    w, h = size
+    ratio = min(1.0, max_w / w, (max_h or h) / h)
+    return max(1, int(w * ratio)), max(1, int(h * ratio))
+
+# 批量解码线程数，0 表示按 CPU 核数自动决定（Pillow 解码/缩放期间会释放 GIL）
+DECODE_WORKERS = int(os.environ.get('IMAGE_TOOL_DECODE_WORKERS', '0')) or min(8, os.cpu_count() or 1)
+
+def _clean_image_isolated(uploaded_file, draft_size=None, key=None):
     try:
-        uploaded_file.seek(0)
-        file_bytes = uploaded_file.read()
-        img = Image.open(io.BytesIO(file_bytes))
-        try:
-            if hasattr(img, '_getexif'):
-                img = ImageOps.exif_transpose(img)
-        except: pass 
-        
-        new_img = Image.new("RGB", img.size, (255, 255, 255))
-        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-            if img.mode != 'RGBA': img = img.convert('RGBA')
-            new_img.paste(img, mask=img.split()[3])
-        else:
-            new_img.paste(img)
-        return new_img
+        return process_uploaded_image(uploaded_file, draft_size, key)
+    except AdmissionRejected as e:
+        notify(f"🚫 {getattr(uploaded_file, 'name', '')} {e}")
+        return Image.new('RGB', (200, 50), (255, 200, 200))
     except Exception:
         return Image.new('RGB', (200, 50), (255, 200, 200))
 
-def clean_image(uploaded_file):
-    return process_uploaded_image(uploaded_file)
-
-def enhance_image(image, upscale_factor=2.0, sharpness=2.0, contrast=1.1, color=1.1):
-    if upscale_factor > 1.0:
-        new_w, new_h = int(image.width * upscale_factor), int(image.height * upscale_factor)
-        img = image.resize((new_w, new_h), Image.Resampling.LANCZOS)
-    else: img = image.copy()
-    img = img.filter(ImageFilter.UnsharpMask(radius=2, percent=150, threshold=3))
-    img = ImageEnhance.Contrast(img).enhance(contrast)
-    img = ImageEnhance.Color(img).enhance(color)
-    img = ImageEnhance.Sharpness(img).enhance(sharpness)
-    return img
-
-def slice_image_by_guides(img, xs, ys):
-    xs = sorted(list(set([0] + xs + [img.width])))
-    ys = sorted(list(set([0] + ys + [img.height])))
-    return [img.crop((xs[i], ys[j], xs[i+1], ys[j+1])) for j in range(len(ys)-1) for i in range(len(xs)-1) if xs[i+1]>xs[i] and ys[j+1]>ys[j]]
-
-def stitch_images_advanced(images_data, mode='vertical', alignment='max', cols=2, padding=0, bg_color='#FFFFFF'):
+def clean_images(uploaded_files, max_workers=None, draft_size=None, keys=None):
+    """并行解码一批上传文件，结果顺序与输入一致，单个文件出错时返回粉色占位图。
+    draft_size 用于只需要缩略图的场景；keys 为各文件的内容哈希，省略时在脚本线程里取 upload_key。"""
+    uploaded_files = list(uploaded_files)
+    keys = list(keys) if keys is not None else [upload_key(f) for f in uploaded_files]
+    workers = min(max_workers or DECODE_WORKERS, len(uploaded_files))
+    if workers <= 1: return [_clean_image_isolated(f, draft_size, k) for f, k in zip(uploaded_files, keys)]
+    ctx = get_script_run_ctx()  # 让工作线程也能访问 st.cache_resource
+    recorder = instrument.current()
+    def init():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        instrument.bind(recorder)
+    with ThreadPoolExecutor(workers, initializer=init) as pool:
+        return list(pool.map(lambda f, k: _clean_image_isolated(f, draft_size, k), uploaded_files, keys))
+
+# 输出超过该像素数时 enhance_image 自动改为分块多进程计算（结果逐像素一致）
+@st.cache_resource(show_spinner=False)
+def get_process_pool():
+    # spawn：Streamlit 服务端是多线程进程，避免 fork 带出锁状态
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('spawn'))
+
+# 修复时同时存活的整图缓冲份数（按输出尺寸 RGB 计）：PIL 路径约 8 份，NumPy 与分块路径约 3 份
+ENHANCE_BUFFERS = {'pil': 8, 'numpy': 3, 'tiled': 3}
+
+def enhance_image(image, upscale_factor=2.0, sharpness=2.0, contrast=1.1, color=1.1, tiled=None, engine='pil', progress=None):
+    if tiled is None: tiled = engine == 'pil' and image_core.wants_tiled(image, upscale_factor)
+    out_bytes = int(image.width * image.height * max(1.0, upscale_factor) ** 2 * 3)
+    with admit_job("高清修复", out_bytes * ENHANCE_BUFFERS['tiled' if tiled else engine]):
+        return image_core.enhance_image(image, upscale_factor, sharpness, contrast, color, tiled, engine,
+                                        executor=get_process_pool() if tiled else None, progress=progress)
+
+
+def enhance_staged(image, image_key, upscale_factor, sharpness, contrast, store, progress=None):
+    """全分辨率 PIL 修复：放大 + USM 的中间结果按 (图片哈希, 倍率) 落盘复用，只改对比/锐化时跳过第一阶段"""
+    out_bytes = int(image.width * image.height * max(1.0, upscale_factor) ** 2 * 3)
+    base_key = ('enhance_base', image_key, upscale_factor)
+    with admit_job("高清修复", out_bytes * ENHANCE_BUFFERS['pil']):
+        base = store.get(base_key)
+        if base is None: base = store.put(base_key, image_core.enhance_base(image, upscale_factor))
+        if progress: progress(1, 2)
+        return image_core.enhance_adjust(base.image(), sharpness, contrast)
+
+# 修复参数的实时预览：输出最长边不超过该值，放大 + USM 阶段按 (图片哈希, 倍率) 记忆
+ENHANCE_PREVIEW_SIZE = 1000
+
+@st.cache_resource(show_spinner=False)
+def get_enhance_preview_cache():
+    return MemoCache(16)
+
+def _enhance_preview_base(img, upscale_factor):
+    out = fit_size((img.width * upscale_factor, img.height * upscale_factor), ENHANCE_PREVIEW_SIZE, ENHANCE_PREVIEW_SIZE)
+    proxy = img if out[0] >= img.width * upscale_factor else preview_of(img, (out[0] / upscale_factor, out[1] / upscale_factor))
+    base = image_core.enhance_base(proxy, upscale_factor)
+    return preview_of(img, base.size), base
+
+@traced('enhance_preview')
+def enhance_preview(img, image_key, upscale_factor, sharpness, contrast):
+    """在视口大小的代理图上预览修复效果，滑块变化只重算对比/锐化阶段。返回 (对应尺寸的原图预览, 修复预览)"""
+    original, base = get_enhance_preview_cache().get_or_create((image_key, upscale_factor),
+                                                               lambda: _enhance_preview_base(img, upscale_factor))
+    return original, image_core.enhance_adjust(base, sharpness, contrast)
+
+# === 流式拼接（实现见 image_core）：预估输出超过阈值时自动走流式路径 ===
+STREAM_STITCH_PIXELS = 60_000_000  # 预估输出超过该像素数时自动走流式拼接
+
+def stitch_images_auto(images_data, mode='vertical', alignment='max', cols=2, padding=0, bg_color='#FFFFFF',
+                       stream_threshold=STREAM_STITCH_PIXELS, progress=None):
+    """预估输出像素数，小任务走内存拼接，超大结果走流式拼接"""
     if not images_data: return None
-    bg_color_rgb = tuple(int(bg_color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
-
-    processed_inputs = []
-    for item in images_data:
-        img = item['img']
-        scale = item['scale']
-        rotate = item['rotate']
-        if rotate != 0: img = img.rotate(-rotate, expand=True)
-        if scale != 1.0:
-            new_w, new_h = int(img.width * scale), int(img.height * scale)
-            if new_w > 0 and new_h > 0: img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-        processed_inputs.append(img)
-
-    images = processed_inputs 
-
-    if mode == 'vertical':
-        max_width = max(img.width for img in images)
-        final_imgs = []
-        for img in images:
-            if alignment == 'max' and img.width != max_width:
-                ratio = max_width / img.width
-                new_height = int(img.height * ratio)
-                img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
-            final_imgs.append(img)
-        total_height = sum(img.height for img in final_imgs) + (len(final_imgs) - 1) * padding
-        result = Image.new('RGB', (max_width, total_height), bg_color_rgb)
-        y_offset = 0
-        for img in final_imgs:
-            x_center = (max_width - img.width) // 2
-            result.paste(img, (x_center, y_offset))
-            y_offset += img.height + padding
-            
-    elif mode == 'horizontal':
-        max_height = max(img.height for img in images)
-        final_imgs = []
-        for img in images:
-            if alignment == 'max' and img.height != max_height:
-                ratio = max_height / img.height
-                new_width = int(img.width * ratio)
-                img = img.resize((new_width, max_height), Image.Resampling.LANCZOS)
-            final_imgs.append(img)
-        total_width = sum(img.width for img in final_imgs) + (len(final_imgs) - 1) * padding
-        result = Image.new('RGB', (total_width, max_height), bg_color_rgb)
-        x_offset = 0
-        for img in final_imgs:
-            y_center = (max_height - img.height) // 2
-            result.paste(img, (x_offset, y_center))
-            x_offset += img.width + padding
-
-    else: 
-        target_width = max(img.width for img in images)
-        resized_imgs = []
-        for img in images:
-            if alignment == 'max':
-                ratio = target_width / img.width
-                new_h = int(img.height * ratio)
-                img = img.resize((target_width, new_h), Image.Resampling.LANCZOS)
-            resized_imgs.append(img)
-        num_images = len(resized_imgs)
-        rows = math.ceil(num_images / cols)
-        row_heights = []
-        for r in range(rows):
-            row_imgs = resized_imgs[r*cols : (r+1)*cols]
-            if row_imgs: max_h_in_row = max(img.height for img in row_imgs)
-            else: max_h_in_row = 0
-            row_heights.append(max_h_in_row)
-        total_w = cols * target_width + (cols - 1) * padding
-        total_h = sum(row_heights) + (rows - 1) * padding
-        result = Image.new('RGB', (total_w, total_h), bg_color_rgb)
-        for i, img in enumerate(resized_imgs):
-            r = i // cols
-            c = i % cols
-            x = c * (target_width + padding)
-            y = sum(row_heights[:r]) + r * padding
-            x_center = x + (target_width - img.width) // 2
-            row_h = row_heights[r]
-            y_center = y + (row_h - img.height) // 2
-            result.paste(img, (x_center, y_center))
-            
-    return result
+    (W, H), _ = stitch_layout(images_data, mode, alignment, cols, padding)
+    if W * H > stream_threshold:
+        # 每张输入经准入控制解码（超大图入库缩小），变换落盘期间另持有该输入的内存租约
+        return stitch_images_streaming(images_data, mode, alignment, cols, padding, bg_color, progress=progress,
+                                       load=functools.partial(image_core.load_source, decoder=admitted_decode), admit=admit_job)
+    pending = [i for i, item in enumerate(images_data) if item.get('img') is None]
+    if pending:
+        images_data = list(images_data)
+        for i, img in zip(pending, clean_images([images_data[i]['file'] for i in pending], keys=[images_data[i].get('key') for i in pending])):
+            images_data[i] = dict(images_data[i], img=img)
+    # 输出画布 + 缩放后的输入，约两份输出大小
+    with admit_job("拼接", W * H * 3 * 2):
+        return stitch_images_advanced(images_data, mode, alignment, cols, padding, bg_color, progress=progress)
+
+# === 拼接实时预览：按原图尺寸计算布局，用缩小后的输入在预览分辨率上合成 ===
+STITCH_PREVIEW_SIZE = 1200
+
+def _proxy_input(item, size):
+    """取得不小于 size（旋转前方向）的缩小版输入"""
+    if item.get('img') is not None: return preview_of(item['img'], fit_size(item['img'].size, *size))
+    bound = 64
+    while bound < max(size): bound *= 2  # 按 2 的幂分桶，提高缩略图缓存命中率
+    return process_uploaded_image(item['file'], (bound, bound), upload_key(item['file']))
+
+@traced('stitch_proxy')
+def stitch_images_proxy(images_data, mode='vertical', alignment='max', cols=2, padding=0, bg_color='#FFFFFF',
+                        preview_size=STITCH_PREVIEW_SIZE):
+    """与 stitch_images_advanced 相同的布局，但只在预览分辨率上合成。返回 (预览图, 原图尺寸)"""
+    if not images_data: return None, (0, 0)
+    bg_color_rgb = parse_color(bg_color)
+    (W, H), boxes = stitch_layout(images_data, mode, alignment, cols, padding)
+    s = min(1.0, preview_size / max(W, H))
+    result = Image.new('RGB', (max(1, round(W * s)), max(1, round(H * s))), bg_color_rgb)
+    for item, (x, y, w, h) in zip(images_data, boxes):
+        tw, th = max(1, round(w * s)), max(1, round(h * s))
+        need = (th, tw) if item['rotate'] in (90, 270) else (tw, th)
+        img = _proxy_input(item, need)
+        if item['rotate'] in TRANSPOSE_FOR_ROTATE: img = img.transpose(TRANSPOSE_FOR_ROTATE[item['rotate']])
+        result.paste(img.resize((tw, th), Image.Resampling.BILINEAR), (round(x * s), round(y * s)))
+    return result, (W, H)
+
+def stitch_settings_key(images_data, mode, alignment, cols, padding, bg_color):
+    return (tuple((upload_key(it['file']), it['scale'], it['rotate']) for it in images_data), mode, alignment, cols, padding, bg_color)
+
+@st.cache_resource(show_spinner=False)
+def get_stitch_preview_cache():
+    return MemoCache(32)
+
+def cached_stitch_proxy(images_data, mode, alignment, cols, padding, bg_color):
+    """按 (输入哈希, 每张缩放/旋转, 模式, 列数, 间距, 背景色) 记忆预览结果"""
+    key = stitch_settings_key(images_data, mode, alignment, cols, padding, bg_color)
+    return get_stitch_preview_cache().get_or_create(key, lambda: stitch_images_proxy(images_data, mode, alignment, cols, padding, bg_color))
+
+# === 切片/框选导出：并行编码，按顺序写入临时 ZIP，结果按 (图片哈希, 切割方案) 缓存 ===
+ZIP_CACHE_ENTRIES = 8
+
+def upload_key(uploaded_file):
+    """上传文件的内容哈希，同一会话内按 file_id 记住，避免每次重跑都重新哈希。
+    没有 file_id 的文件副本或没有会话的后台任务线程里直接哈希"""
+    file_id = getattr(uploaded_file, 'file_id', None)
+    if file_id is None or get_script_run_ctx() is None: return DecodedImageCache.key_for(uploaded_file.getvalue())
+    keys = st.session_state.setdefault('_upload_keys', {})
+    if file_id not in keys: keys[file_id] = DecodedImageCache.key_for(uploaded_file.getvalue())
+    return keys[file_id]
+
+@st.cache_resource(show_spinner=False)
+def get_zip_cache():
+    return ArchiveCache(ZIP_CACHE_ENTRIES)
+
+def _zip_job(job, cache, key, img, boxes, names):
+    # 任务结果只是缓存 key，归档本身只在 ArchiveCache 里保留一份
+    if key not in cache: cache.put(key, build_crops_zip(img, boxes, names, progress=job.report, max_workers=DECODE_WORKERS))
+    return key
+
+def export_crops_zip(img, slot, key, boxes, names, label="打包"):
+    """在后台任务里编码 ZIP，已缓存的归档直接复用"""
+    cache = get_zip_cache()
+    if key not in cache: get_job_manager().discard(key)  # 归档已被淘汰，重新打包
+    return submit_job(slot, key, label, _zip_job, cache, key, img, boxes, names)
+
+def zip_download_ui(slot, key, file_name, **kwargs):
+    """slot 上的打包任务对应当前切割方案时显示进度；完成后点击准备才从归档缓存读出字节，平时重跑不读文件"""
+    if st.session_state.get(slot) != key: return
+    job = job_status_ui(slot)
+    if job is None: return
+    cache = get_zip_cache()
+    if job.result in cache:
+        if not st.button("📦 准备 ZIP", key=f"{slot}_prepare", **kwargs): return
+        data = cache.get(job.result)
+        if data is not None:
+            st.download_button("📦 下载ZIP", data, file_name, "application/zip", type="primary", key=f"{slot}_dl", **kwargs)
+            return
+    st.session_state.pop(slot, None)
+    st.info("打包结果已被清理，请重新切割")
+
+# === 会话结果落盘（实现见 result_store）：结果以 raw 像素文件保存，内存里只留预览 ===
+RESULT_DIR = os.environ.get('IMAGE_TOOL_RESULT_DIR') or None   # 默认系统临时目录
+RESULT_STORE_MB = int(os.environ.get('IMAGE_TOOL_RESULT_STORE_MB', '8192'))
+RESULT_TTL_S = float(os.environ.get('IMAGE_TOOL_RESULT_TTL_S', '3600'))  # 超过该时长未被查看的结果被清理
+
+@st.cache_resource(show_spinner=False)
+def get_result_store():
+    return SessionResultStore(RESULT_DIR, RESULT_STORE_MB * 1024 * 1024, RESULT_TTL_S, resize=preview_of)
+
+def _session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+def set_session_result(name, value):
+    """写入 session_state 并登记到结果存储，用于按会话统计占用"""
+    st.session_state[name] = value
+    get_result_store().assign(_session_id(), name, value)
+
+def session_result(name, label):
+    """取出会话结果；已被淘汰的落盘结果提示重新生成并清除"""
+    get_result_store().evict()
+    value = st.session_state.get(name)
+    if isinstance(value, StoredImage) and value.expired:
+        st.info(f"{label}结果长时间未查看已被清理，请重新生成")
+        set_session_result(name, None)
+        return None
+    return value
+
+def result_footprint_caption():
+    store = get_result_store()
+    mine, total = store.footprint(_session_id()), store.footprint()
+    st.caption(f"💾 结果已落盘：本会话 {mine['disk_bytes'] / 2**20:.0f} MB（内存预览 {mine['memory_bytes'] / 2**20:.1f} MB）· "
+               f"全部会话 {total['disk_bytes'] / 2**20:.0f} MB / {total['entries']} 个")
+
+# === 后台任务：拼接 / 修复 / 打包放进共享线程池，按输入 key 去重，页面只轮询进度 ===
+JOB_WORKERS = int(os.environ.get('IMAGE_TOOL_JOB_WORKERS', '2'))
+JOB_KEEP = int(os.environ.get('IMAGE_TOOL_JOB_KEEP', '8'))  # 保留结果的已结束任务数
+
+@st.cache_resource(show_spinner=False)
+def get_job_manager():
+    return jobs.JobManager(JOB_WORKERS, JOB_KEEP)
+
+def submit_job(slot, key, label, fn, *args):
+    """提交 fn(job, *args) 并把 key 记在会话的 slot 上；任务内的埋点单独记为一次 job:<label>"""
+    stats, manager = get_span_stats(), get_job_manager()
+    done = manager.get(key)
+    if done is not None and getattr(done.result, 'expired', False): manager.discard(key)  # 落盘结果已被淘汰，重新计算
+    def run(job, *args):
+        recorder = instrument.start(f"job:{label}")
+        try: return fn(job, *args)
+        finally: instrument.finish(recorder, stats, SPAN_LOG, job=label)
+    st.session_state[slot] = key
+    return manager.submit(key, label, run, *args)
+
+@st.fragment(run_every=1)
+def _job_progress(slot, key):
+    job = get_job_manager().get(key)
+    if job is None or not job.active(): st.rerun()
+    c1, c2 = st.columns([4, 1])
+    state = "正在取消…" if job.cancelling else (job.message or ("排队中" if job.status == jobs.QUEUED else "处理中"))
+    c1.progress(job.progress, f"{job.label}：{state} · {job.elapsed():.0f} 秒")
+    if c2.button("⏹️ 取消", key=f"{slot}_cancel", disabled=job.cancelling, use_container_width=True): job.cancel()
+
+def job_status_ui(slot):
+    """会话在 slot 上的任务：运行中显示进度和取消按钮，失败或取消时提示并清除 slot。返回已完成的任务"""
+    job = get_job_manager().get(st.session_state.get(slot))
+    if job is None:
+        st.session_state.pop(slot, None)
+        return None
+    if job.active():
+        _job_progress(slot, job.key)
+        return None
+    if job.status == jobs.DONE: return job
+    st.session_state.pop(slot, None)
+    if isinstance(job.error, AdmissionRejected): st.error(f"🚫 {job.error}")
+    elif job.status == jobs.FAILED: st.error(f"{job.label}错误: {job.error}")
+    else: st.info(f"{job.label}已取消")
+    return None
+
+def _stitch_job(job, store, *stitch_args):
+    res = stitch_images_auto(*stitch_args, progress=job.report)
+    return store.put(job.key, res) if isinstance(res, Image.Image) else res
+
+def _enhance_job(job, store, img, image_key, upscale, sharpness, contrast, engine):
+    if engine == 'pil' and not image_core.wants_tiled(img, upscale):
+        return store.put(job.key, enhance_staged(img, image_key, upscale, sharpness, contrast, store, progress=job.report))
+    return store.put(job.key, enhance_image(img, upscale, sharpness, contrast, engine=engine, progress=job.report))
+
+# === 大图导出：点击后才编码，结果按 (图片对象, 格式, 预设) 缓存，图片被回收时一并释放 ===
+EXPORT_THREADS = int(os.environ.get('IMAGE_TOOL_EXPORT_THREADS', '0')) or min(4, os.cpu_count() or 1)
+EXPORT_CACHE_MB = int(os.environ.get('IMAGE_TOOL_EXPORT_CACHE_MB', '512'))
+EXPORT_PRESET_LABELS = {'fast': "⚡ 最快", 'balanced': "⚖️ 均衡", 'small': "📦 最小"}
+
+@st.cache_resource(show_spinner=False)
+def get_export_cache():
+    return EncodedRegistry(EXPORT_CACHE_MB * 1024 * 1024)
+
+def export_image_ui(img, name, key, label="📥 下载"):
+    """格式/预设选择 + 按需编码的下载按钮；设置不变时重跑只复用缓存结果。img 可以是 StoredImage"""
+    c1, c2 = st.columns(2)
+    fmt = c1.selectbox("格式", list(image_export.FORMATS), key=f"{key}_fmt")
+    preset = c2.selectbox("压缩预设", image_export.PRESETS, index=1, format_func=EXPORT_PRESET_LABELS.get, key=f"{key}_preset")
+    cache = get_export_cache()
+    enc = cache.get(img, fmt, preset)
+    if enc is None:
+        if not st.button(f"🧩 生成 {fmt} 文件", key=f"{key}_encode", use_container_width=True): return
+        with st.spinner(f"正在编码 {fmt}..."):
+            full = img.image() if isinstance(img, StoredImage) else img
+            enc = cache.put(img, image_export.encode_image(full, fmt, preset, threads=EXPORT_THREADS), preset)
+    st.download_button(label, enc.data, f"{name}.{enc.ext}", enc.mime, type="primary", use_container_width=True, key=f"{key}_dl")
+    st.caption(f"{enc.fmt} · {len(enc.data) / 1024 / 1024:.2f} MB · 编码耗时 {enc.seconds:.2f} 秒")
+
+def streamed_download_ui(res, name, key, label="📥 下载"):
+    """流式结果的下载：PNG 只在点击准备后读入一次，平时重跑不读文件、不占媒体存储"""
+    if st.button("🧩 准备 PNG 文件", key=f"{key}_prepare", use_container_width=True):
+        with res.open() as fp:
+            st.download_button(label, fp, f"{name}.png", "image/png", type="primary", use_container_width=True, key=f"{key}_dl")
+    st.caption(f"PNG · {os.path.getsize(res.path) / 1024 / 1024:.2f} MB")
+
+# === 参考线预览：缩放底图按 (文件, 缩放) 缓存，参考线增量绘制 ===
+GUIDE_LINE_WIDTH = 3
+GUIDE_COLORS = {'x': 'red', 'y': 'blue'}
+
+class GuideOverlay:
+    """base 为只读底图（可以是共享的原图或金字塔级别），只有 frame 是自己的副本"""
+    def __init__(self, base, z):
+        self.base, self.z = base, z
+        self.frame = base.copy()
+        self.drawn = {'x': set(), 'y': set()}
+
+    def _line_box(self, axis, v):
+        """参考线所在窄条，线完全在图外时为 None"""
+        # 线宽 3 只覆盖中心 ±1 像素，按整条线宽留余量
+        pad = GUIDE_LINE_WIDTH
+        p = int(v * self.z)
+        if axis == 'x': box = (max(0, p - pad), 0, min(self.base.width, p + pad + 1), self.base.height)
+        else: box = (0, max(0, p - pad), self.base.width, min(self.base.height, p + pad + 1))
+        return box if box[0] < box[2] and box[1] < box[3] else None
+
+    def _render_box(self, box):
+        """用底图重画 box 区域，并按全量绘制时的顺序（先红后蓝）补画经过该区域的参考线。
+        在外扩的区域上绘制再只贴回 box，避免线条中心落在负坐标时的裁剪差异。"""
+        pad = 2 * GUIDE_LINE_WIDTH
+        outer = (max(0, box[0] - pad), max(0, box[1] - pad),
+                 min(self.base.width, box[2] + pad), min(self.base.height, box[3] + pad))
+        x0, y0, x1, y1 = outer
+        patch = self.base.crop(outer)
+        draw = ImageDraw.Draw(patch)
+        for axis in ('x', 'y'):
+            for v in sorted(self.drawn[axis]):
+                lb = self._line_box(axis, v)
+                if lb is None or not (lb[0] < x1 and x0 < lb[2] and lb[1] < y1 and y0 < lb[3]): continue
+                if axis == 'x':
+                    p = v * self.z - x0
+                    draw.line([(p, 0), (p, patch.height)], fill=GUIDE_COLORS[axis], width=GUIDE_LINE_WIDTH)
+                else:
+                    p = v * self.z - y0
+                    draw.line([(0, p), (patch.width, p)], fill=GUIDE_COLORS[axis], width=GUIDE_LINE_WIDTH)
+        inner = (box[0] - x0, box[1] - y0, box[2] - x0, box[3] - y0)
+        self.frame.paste(patch.crop(inner), box[:2])
+
+    @traced('guides')
+    def sync(self, xs, ys):
+        """同步到给定参考线集合，只重绘增删的线所在的窄条"""
+        wanted = {'x': set(xs), 'y': set(ys)}
+        changed = []
+        for axis in ('x', 'y'):
+            for v in self.drawn[axis] ^ wanted[axis]: changed.append(self._line_box(axis, v))
+            self.drawn[axis] = wanted[axis]
+        for box in changed:
+            if box is not None: self._render_box(box)
+        return self.frame
+
+def nearest_guide(sorted_values, v):
+    """在已排序的参考线列表中二分查找离 v 最近的一条"""
+    i = bisect.bisect_left(sorted_values, v)
+    candidates = sorted_values[max(0, i - 1):i + 1]
+    return min(candidates, key=lambda u: abs(u - v))
+
+# === 画布素材：代理图编码一次、按内容哈希去重，经媒体端点以 URL 引用，fabric JSON 只带几何信息 ===
+CANVAS_ASSET_CACHE_MB = int(os.environ.get('IMAGE_TOOL_CANVAS_ASSET_CACHE_MB', '256'))
+CANVAS_JPEG_QUALITY = 90
+
+@st.cache_resource(show_spinner=False)
+def get_canvas_assets():
+    return CanvasAssetStore(CANVAS_ASSET_CACHE_MB * 1024 * 1024, CANVAS_JPEG_QUALITY)
+
+def _publish_asset(key):
+    """把素材登记到当前会话的媒体文件（同一内容得到同一 URL），无运行时（裸模式）时退回 data URL"""
+    store = get_canvas_assets()
+    asset = store.get(key)
+    if asset is None: return None
+    data, mime = asset
+    if not st.runtime.exists():
+        url = f"data:{mime};base64,{base64.b64encode(data).decode()}"
+    else:
+        url = st.runtime.get_instance().media_file_mgr.add(data, mime, f"canvas_asset.{key}")
+        base = st.get_option('server.baseUrlPath').strip('/')
+        url = f"/{base}{url}" if base else url
+    store.register_url(url, key)
+    return url
+
+def canvas_asset_key(src):
+    """由 fabric 返回的 src（浏览器会补全为绝对地址）找回素材哈希"""
+    if not src: return None
+    store = get_canvas_assets()
+    if src.startswith('data:'): return store.key_for_url(src)
+    return store.key_for_url(urllib.parse.urlsplit(src).path)
+
+def canvas_image_src(img):
+    """代替 image_to_base64 作为 fabric 图片对象的 src"""
+    return _publish_asset(get_canvas_assets().add(img))
+
+def publish_canvas_assets(drawing):
+    """媒体文件只在引用它的那次运行内有效，渲染画布前为 JSON 里引用的素材重新登记"""
+    if not drawing: return drawing
+    store = get_canvas_assets()
+    with span('canvas_json') as sp:
+        for obj in drawing.get('objects', []):
+            if obj.get('type') != 'image': continue
+            # 素材被淘汰后它的 url 也已删除，两种情况都按缺失处理
+            key = store.key_for_url(obj.get('src'))
+            if key is None or _publish_asset(key) is None:
+                st.warning("画布素材已被缓存淘汰，请重新上传图片")
+                break
+        sp.describe(json.dumps(drawing))
+    return drawing
+
+# === 自由画布对象：按 (内容哈希, 第几份) 增量维护，增删素材只处理变化的文件 ===
+CANVAS_THUMB_WIDTH = 400
+
+def _canvas_image_object(src, size, idx):
+    return {
+        "type": "image", "version": "4.4.0", "originX": "left", "originY": "top",
+        "left": 50 + (idx * 30), "top": 50 + (idx * 30),
+        "width": size[0], "height": size[1],
+        "fill": "rgb(0,0,0)", "stroke": None, "strokeWidth": 0,
+        "scaleX": 1, "scaleY": 1, "angle": 0, "flipX": False, "flipY": False,
+        "opacity": 1, "visible": True, "backgroundColor": "",
+        "src": src, "selectable": True, "evented": True
+    }
+
+def canvas_object_assets(objects):
+    return sorted(canvas_asset_key(obj.get('src')) or '' for obj in objects if obj.get('type') == 'image')
+
+def sync_canvas_objects(files, objects, items):
+    """新文件解码后追加对象，移除的文件删掉对应对象，其余对象保留用户的变换和已编码的素材。
+    items 为上次的 {(内容哈希, 第几份): 素材哈希}，返回 (对象列表, items, 素材哈希 -> 上传文件)"""
+    wanted, seen = [], Counter()
+    for f in files:
+        h = upload_key(f)
+        wanted.append(((h, seen[h]), f))
+        seen[h] += 1
+    keys = {k for k, _ in wanted}
+    drop = Counter(asset for k, asset in items.items() if k not in keys)
+    kept = []
+    # 同一素材出现多次时从后往前删，与文件列表里的顺序对应
+    for obj in reversed(objects):
+        asset = canvas_asset_key(obj.get('src')) if obj.get('type') == 'image' else None
+        if asset is not None and drop[asset] > 0:
+            drop[asset] -= 1
+            continue
+        # fabric 返回的 src 是浏览器补全的绝对地址，换回登记用的地址
+        if asset is not None: obj = dict(obj, src=_publish_asset(asset) or obj['src'])
+        kept.append(obj)
+    kept.reverse()
+    items = {k: asset for k, asset in items.items() if k in keys}
+    new = [(k, f) for k, f in wanted if k not in items]
+    for (k, f), img in zip(new, clean_images([f for _, f in new], keys=[k[0] for k, _ in new])):
+        if img.width > CANVAS_THUMB_WIDTH:
+            img = preview_of(img, (CANVAS_THUMB_WIDTH, int(img.height * CANVAS_THUMB_WIDTH / img.width)))
+        items[k] = get_canvas_assets().add(img)
+        kept.append(_canvas_image_object(_publish_asset(items[k]), img.size, len(kept)))
+    return kept, items, {items[k]: f for k, f in wanted}
+
+# === 自由画布原图渲染：按 fabric JSON 用原图逐条带合成，超大输出直接流式写 PNG ===
+def unresolved_objects(objects, sources):
+    """找不到原图、渲染时会被跳过的图片对象数"""
+    return sum(1 for obj in objects if obj.get('type') == 'image' and canvas_asset_key(obj.get('src')) not in sources)
+
+@traced('canvas_render')
+def render_free_canvas(objects, sources, canvas_size, bg_color='#FFFFFF', scale=1.0, stream_threshold=STREAM_STITCH_PIXELS, progress=None):
+    """sources: 素材哈希 -> 文件对象，原图经准入控制解码，找不到原图的对象跳过"""
+    bg_rgb = parse_color(bg_color)
+    def resolve(obj):
+        f = sources.get(canvas_asset_key(obj.get('src')))
+        return process_uploaded_image(f) if f is not None else None
+    W, H = canvas_render.output_size(canvas_size, scale)
+    bands = canvas_render.render_bands(objects, resolve, canvas_size, bg_rgb, scale)
+    if W * H <= stream_threshold:
+        with admit_job("原图渲染", W * H * 3):  # 输出画布，条带只占其中一小部分
+            result = Image.new('RGB', (W, H), bg_rgb)
+            for y0, band in bands:
+                result.paste(band, (0, y0))
+                if progress: progress(y0 + band.height, H)
+            return result
+    ratio = min(1.0, STREAM_PREVIEW_SIZE / max(W, H))
+    preview = Image.new('RGB', (max(1, int(W * ratio)), max(1, int(H * ratio))), bg_rgb)
+    out = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
+    try:
+        writer = PNGStreamWriter(out, W, H)
+        for y0, band in bands:
+            writer.write_rows(band.tobytes())
+            p0, p1 = int(y0 * ratio), int((y0 + band.height) * ratio)
+            if p1 > p0: preview.paste(band.resize((preview.width, p1 - p0), Image.Resampling.BILINEAR), (0, p0))
+            if progress: progress(y0 + band.height, H)
+        writer.close()
+    except BaseException:
+        out.close()
+        os.remove(out.name)
+        raise
+    out.close()
+    return StreamedStitch(out.name, (W, H), preview)
+
+def _free_render_job(job, store, *render_args):
+    res = render_free_canvas(*render_args, progress=job.report)
+    return store.put(job.key, res) if isinstance(res, Image.Image) else res
+
+# === 耗时埋点：每次重跑的 span 汇总，可选侧边栏面板，JSON Lines 日志与 Prometheus 文本 ===
+SPAN_LOG = os.environ.get('IMAGE_TOOL_SPAN_LOG') or None
+DEBUG_PANEL = os.environ.get('IMAGE_TOOL_DEBUG_PANEL') == '1'
+
+@st.cache_resource(show_spinner=False)
+def get_span_stats():
+    return instrument.SpanStats()
+
+def render_debug_panel(recorder):
+    """侧边栏：本次重跑各 span 的汇总与明细"""
+    with st.sidebar.expander(f"🐞 本次重跑 {recorder.elapsed * 1000:.0f} ms", expanded=True):
+        totals = sorted(recorder.totals().items(), key=lambda kv: -kv[1]['seconds'])
+        st.dataframe([{"span": name, "次数": t['calls'], "ms": round(t['seconds'] * 1000, 1), "KB": round(t['bytes'] / 1024, 1)}
+                      for name, t in totals], hide_index=True, use_container_width=True)
+        rows = []
+        for name, start, seconds, depth, attrs in sorted(recorder.spans, key=lambda sp: sp[1]):
+            detail = " ".join(f"{k}={v}" for k, v in attrs.items())
+            rows.append({"span": "· " * depth + name, "开始 ms": round(start * 1000, 1), "ms": round(seconds * 1000, 1), "详情": detail})
+        st.dataframe(rows, hide_index=True, use_container_width=True)
+        result_footprint_caption()
+
+# === 工具页隔离：每个标签页是一个 fragment，页内交互只重跑该页，重跑耗时只取决于当前工具 ===
+def tool_fragment(name):
+    """把工具页包成 fragment；单独重跑时另起一次埋点记录（名称为标签页名）"""
+    def wrap(fn):
+        @st.fragment
+        @functools.wraps(fn)
+        def run():
+            if not is_fragment_run():
+                with span(name): return fn()
+            recorder = instrument.start(name)
+            try:
+                with span(name): return fn()
+            finally: finish_run(recorder, fragment=name)
+        return run
+    return wrap
+
+def is_fragment_run():
+    ctx = get_script_run_ctx()
+    return bool(ctx and ctx.fragment_ids_this_run)
+
+def rerun_tool():
+    """页内状态变化后的重跑：fragment 单独运行时只重跑本页，整页运行中则重跑整个应用"""
+    st.rerun(scope='fragment' if is_fragment_run() else 'app')
+
+def finish_run(recorder, **extra):
+    """结束一次（整页或单个工具页的）重跑：汇总埋点并刷新指标文件"""
+    instrument.finish(recorder, get_span_stats(), SPAN_LOG, session=_session_id(), **extra)
+    if METRICS_FILE:
+        try:
+            with open(METRICS_FILE + '.tmp', 'w') as fp:
+                fp.write(get_decoded_cache().prometheus_text() + get_memory_budget().prometheus_text() + get_result_store().prometheus_text()
+                         + get_span_stats().prometheus_text())
+            os.replace(METRICS_FILE + '.tmp', METRICS_FILE)
+        except OSError: pass
 
 # === 主界面 ===
 st.title("🛠️ 全能图片工具箱 Pro Max")
@@ -186,20 +701,21 @@ st.title("🛠️ 全能图片工具箱 Pro Max")
 tab1, tab2, tab3, tab4, tab5 = st.tabs(["🧩 智能拼图", "🔪 参考线切图", "💎 高清修复", "🔳 自由框选切割", "🎨 自由画布"])
 
 # --- Tab 1: 拼图 ---
-with tab1:
+@tool_fragment('tab1')
+def stitch_tool():
     st.header("图片拼接")
     files = st.file_uploader("上传图片", type=['png','jpg','jpeg','webp'], accept_multiple_files=True, key="stitch_up")
     
     if files:
         st.info("👇 **单张图片调整区** (排序、缩放、旋转)")
         image_settings = []
+        thumbs = clean_images(files, draft_size=THUMB_SIZE)
         for i, f in enumerate(files):
             with st.container():
                 c1, c2, c3, c4 = st.columns([1, 1, 1, 1])
                 with c1:
                     try:
-                        img_safe = clean_image(f)
-                        st.image(img_safe, use_column_width=True)
+                        st.image(thumbs[i], use_column_width=True)
                     except:
                         st.error("图片错误")
                         continue
@@ -209,7 +725,7 @@ with tab1:
                     scale = st.slider(f"缩放", 0.1, 2.0, 1.0, 0.1, key=f"scale_{i}")
                 with c4:
                     rotate = st.selectbox(f"旋转", [0, 90, 180, 270], key=f"rot_{i}", format_func=lambda x: f"🔄 {x}°")
-                image_settings.append({"file": f,"img": img_safe,"rank": rank,"scale": scale,"rotate": rotate})
+                image_settings.append({"file": f,"rank": rank,"scale": scale,"rotate": rotate})
                 st.divider()
 
         sorted_settings = sorted(image_settings, key=lambda x: x["rank"])
@@ -229,17 +745,29 @@ with tab1:
             padding = st.slider("间距", 0, 100, 0)
             bg_color = st.color_picker("背景色", "#FFFFFF")
 
-        if st.button("✨ 开始拼接", type="primary", use_container_width=True):
-            try:
-                cols_param = grid_cols if stitch_mode == 'grid' else 1
-                st.session_state['stitched_result'] = stitch_images_advanced(
-                    sorted_settings, mode=stitch_mode, alignment=align_mode, cols=cols_param, padding=padding, bg_color=bg_color
-                )
-            except Exception as e:
-                st.error(f"拼接错误: {e}")
+        cols_param = grid_cols if stitch_mode == 'grid' else 1
+        stitch_args = (sorted_settings, stitch_mode, align_mode, cols_param, padding, bg_color)
+        try:
+            proxy, (out_w, out_h) = cached_stitch_proxy(*stitch_args)
+            st.image(proxy, use_column_width=True, caption=f"实时预览 · 输出尺寸 {out_w} x {out_h}")
+        except Exception as e:
+            st.error(f"预览错误: {e}")
+
+        settings_key = stitch_settings_key(*stitch_args)
+        if st.button("✨ 生成高清大图", type="primary", use_container_width=True):
+            # 任务线程读自己的文件副本，不和本会话的重跑争用上传文件的读指针；带上已算好的内容哈希
+            job_inputs = [dict(it, file=io.BytesIO(it['file'].getvalue()), key=upload_key(it['file'])) for it in sorted_settings]
+            submit_job('stitch_job', ('stitch', settings_key), "拼接", _stitch_job, get_result_store(), job_inputs, *stitch_args[1:])
+        job = job_status_ui('stitch_job')
+        if job is not None:
+            set_session_result('stitched_result', job.result)
+            st.session_state['stitched_key'] = job.key[1]
+            del st.session_state['stitch_job']
+        elif st.session_state['stitched_result'] and st.session_state.get('stitched_key') != settings_key:
+            st.warning("设置已变化，下方高清大图不是最新结果，请重新生成")
             
-    if st.session_state['stitched_result']:
-        res = st.session_state['stitched_result']
+    res = session_result('stitched_result', "拼接")
+    if res:
         st.success(f"拼接完成！尺寸: {res.width} x {res.height}")
         col_view1, col_view2 = st.columns([1, 3])
         with col_view1:
@@ -250,19 +778,31 @@ with tab1:
             else:
                 st.caption("已锁定适应窗口宽度")
 
-        st.download_button("📥 下载拼接大图", convert_image_to_bytes(res), "stitch.png", "image/png", type="primary", use_container_width=True)
+        streamed = isinstance(res, StreamedStitch)
+        if streamed:
+            st.caption("结果较大，已使用低内存流式拼接，预览为缩略图")
+            streamed_download_ui(res, "stitch", "st_stream", "📥 下载拼接大图")
+        else:
+            export_image_ui(res, "stitch", "st_export", "📥 下载拼接大图")
+            result_footprint_caption()
         if fit_screen:
-            st.image(res, use_column_width=True, caption="预览 (适应窗口)")
+            view = res.preview if streamed else res.view(fit_size(res.size, 1600))
+            st.image(view, use_column_width=True, caption="预览 (适应窗口)")
         else:
             new_w = max(1, int(res.width * zoom_factor / 100))
-            st.image(res, width=new_w, caption=f"预览 ({zoom_factor}%)")
+            view = res.preview if streamed else res.view((new_w, max(1, int(res.height * new_w / res.width))))
+            st.image(view, width=new_w, caption=f"预览 ({zoom_factor}%)")
+
+with tab1: stitch_tool()
 
 # --- Tab 2: 参考线切图 ---
-with tab2:
+@tool_fragment('tab2')
+def slice_tool():
     st.header("参考线贯穿切割 (Guillotine)")
     f = st.file_uploader("上传图片", type=['png','jpg','jpeg'], key="sl_up")
     if f:
         img = clean_image(f)
+        if img is None: return
         if 'current_img' not in st.session_state or st.session_state.current_img != f.name:
             st.session_state.x_cuts, st.session_state.y_cuts = [], []
             st.session_state.cut_history = []
@@ -275,36 +815,36 @@ with tab2:
             op_mode = st.radio("操作模式", ["➕ 添加参考线", "✋ 移动/调整参考线"], horizontal=True)
             if op_mode == "✋ 移动/调整参考线": st.info("点击参考线附近可移动它")
             line_type = st.radio("类型", ["⬇️ 垂直线", "➡️ 水平线"])
-            st.caption(f"X: {sorted(st.session_state.x_cuts)}")
-            st.caption(f"Y: {sorted(st.session_state.y_cuts)}")
+            st.caption(f"X: {st.session_state.x_cuts}")
+            st.caption(f"Y: {st.session_state.y_cuts}")
             b_col1, b_col2 = st.columns(2)
             with b_col1:
                 if st.button("🗑️ 清空", use_container_width=True): 
                     st.session_state.x_cuts, st.session_state.y_cuts = [], []
                     st.session_state.cut_history = []
-                    st.rerun()
+                    rerun_tool()
             with b_col2:
                 if st.button("↩️ 撤销", use_container_width=True):
                     if st.session_state.cut_history:
                         last_type, last_val = st.session_state.cut_history.pop()
                         if last_type == 'x' and last_val in st.session_state.x_cuts: st.session_state.x_cuts.remove(last_val)
                         elif last_type == 'y' and last_val in st.session_state.y_cuts: st.session_state.y_cuts.remove(last_val)
-                        st.rerun()
+                        rerun_tool()
             st.write("---")
+            boxes = guide_boxes(img.size, st.session_state.x_cuts, st.session_state.y_cuts)
+            slice_key = ('slices', upload_key(f), tuple(boxes))
             if st.button("✂️ 切割下载", type="primary", use_container_width=True):
-                slices = slice_image_by_guides(img, st.session_state.x_cuts, st.session_state.y_cuts)
-                buf = io.BytesIO()
-                with zipfile.ZipFile(buf, "w") as zf:
-                    for i, s in enumerate(slices):
-                        b = io.BytesIO(); s.save(b, 'PNG'); zf.writestr(f"slice_{i+1}.png", b.getvalue())
-                st.download_button("📦 下载ZIP", buf.getvalue(), "slices.zip", "application/zip", use_container_width=True)
+                export_crops_zip(img, 'slice_job', slice_key, boxes, [f"slice_{i+1}.png" for i in range(len(boxes))], "切片打包")
+            zip_download_ui('slice_job', slice_key, "slices.zip", use_container_width=True)
                 
         with c2:
-            prev = img.resize((int(img.width*z), int(img.height*z))) if z<1 else img.copy()
-            draw = ImageDraw.Draw(prev)
-            for x in st.session_state.x_cuts: draw.line([(x*z,0),(x*z,prev.height)], fill='red', width=3)
-            for y in st.session_state.y_cuts: draw.line([(0,y*z),(prev.width,y*z)], fill='blue', width=3)
-            val = streamlit_image_coordinates(prev, key="sl_pad")
+            overlay_key = (f.file_id, z)
+            if st.session_state.get('guide_overlay_key') != overlay_key:
+                st.session_state['guide_overlay'] = GuideOverlay(shared_preview_of(img, (img.width*z, img.height*z)), z)
+                st.session_state['guide_overlay_key'] = overlay_key
+            prev = st.session_state['guide_overlay'].sync(st.session_state.x_cuts, st.session_state.y_cuts)
+            # JPEG 帧比未压缩 PNG 小一个数量级，每次点击传给浏览器的数据量随之下降
+            val = streamlit_image_coordinates(prev, key="sl_pad", image_format="JPEG", jpeg_quality=85)
             
             if val and val != st.session_state.last_click:
                 st.session_state.last_click = val
@@ -312,46 +852,66 @@ with tab2:
                 if "添加" in op_mode:
                     if "垂直" in line_type: 
                         if click_x not in st.session_state.x_cuts: 
-                            st.session_state.x_cuts.append(click_x)
+                            bisect.insort(st.session_state.x_cuts, click_x)
                             st.session_state.cut_history.append(('x', click_x))
                     else:
                         if click_y not in st.session_state.y_cuts: 
-                            st.session_state.y_cuts.append(click_y)
+                            bisect.insort(st.session_state.y_cuts, click_y)
                             st.session_state.cut_history.append(('y', click_y))
                 else:
                     if "垂直" in line_type:
                         if st.session_state.x_cuts:
-                            closest_x = min(st.session_state.x_cuts, key=lambda x: abs(x - click_x))
+                            closest_x = nearest_guide(st.session_state.x_cuts, click_x)
                             st.session_state.x_cuts.remove(closest_x)
-                            st.session_state.x_cuts.append(click_x)
+                            bisect.insort(st.session_state.x_cuts, click_x)
                             st.toast(f"已移动垂直线")
                     else:
                         if st.session_state.y_cuts:
-                            closest_y = min(st.session_state.y_cuts, key=lambda y: abs(y - click_y))
+                            closest_y = nearest_guide(st.session_state.y_cuts, click_y)
                             st.session_state.y_cuts.remove(closest_y)
-                            st.session_state.y_cuts.append(click_y)
+                            bisect.insort(st.session_state.y_cuts, click_y)
                             st.toast(f"已移动水平线")
-                st.rerun()
+                rerun_tool()
+
+with tab2: slice_tool()
 
 # --- Tab 3: 修复 ---
-with tab3:
+@tool_fragment('tab3')
+def restore_tool():
     st.header("高清修复")
     f = st.file_uploader("上传图片", type=['png','jpg'], key="re_up")
     if f:
         img = clean_image(f)
-        with st.expander("参数"):
+        if img is None: return
+        with st.expander("参数", expanded=True):
             up, sh, co = st.checkbox("2倍放大", True), st.slider("锐化",0.0,5.0,2.0), st.slider("对比",0.5,2.0,1.2)
-        if st.button("🚀 修复", type="primary"):
-            st.session_state['restored_image'] = enhance_image(img, 2.0 if up else 1.0, sh, co)
-        if st.session_state['restored_image']:
-            res = st.session_state['restored_image']
-            st.download_button("📥 下载", convert_image_to_bytes(res), "fixed.png", "image/png", type="primary")
-            z = st.slider("对比缩放", 10, 100, 50, key="re_z") / 100.0
-            dw, dh = int(res.width*z), int(res.height*z)
-            image_comparison(img1=img.resize((dw,dh)), img2=res.resize((dw,dh)), label1="原图", label2="修复", width=dw, show_labels=True, in_memory=True)
+            engine = st.radio("计算引擎", ['pil', 'numpy'], horizontal=True, format_func=lambda x: "PIL (多核分块)" if x=='pil' else "NumPy (省内存)")
+        image_key, upscale = upload_key(f), 2.0 if up else 1.0
+        original, preview = enhance_preview(img, image_key, upscale, sh, co)
+        z = st.slider("对比缩放", 10, 100, 100, key="re_z") / 100.0
+        dw, dh = max(1, int(preview.width*z)), max(1, int(preview.height*z))
+        image_comparison(img1=preview_of(original, (dw,dh)), img2=preview_of(preview, (dw,dh)), label1="原图", label2="修复", width=dw, show_labels=True, in_memory=True)
+        st.caption(f"实时预览为 {preview.width} x {preview.height} 代理图，全分辨率输出 {int(img.width * upscale)} x {int(img.height * upscale)}")
+
+        enhance_key = ('enhance', image_key, up, sh, co, engine)
+        if st.button("🚀 生成全分辨率结果", type="primary"):
+            submit_job('enhance_job', enhance_key, "高清修复", _enhance_job, get_result_store(), img, image_key, upscale, sh, co, engine)
+        job = job_status_ui('enhance_job')
+        if job is not None:
+            set_session_result('restored_image', job.result)
+            st.session_state['restored_key'] = job.key
+            del st.session_state['enhance_job']
+        res = session_result('restored_image', "修复")
+        if res:
+            if st.session_state.get('restored_key') != enhance_key: st.warning("参数已变化，下方是之前参数的全分辨率结果，请重新生成")
+            export_image_ui(res, "fixed", "re_export")
+            result_footprint_caption()
+
+with tab3: restore_tool()
 
 # --- Tab 4: 自由框选切割 (防抖动终极版) ---
-with tab4:
+@tool_fragment('tab4')
+def crop_tool():
     st.header("🔳 自由框选切割 (Free Crop)")
     crop_file = st.file_uploader("上传图片", type=['png', 'jpg', 'jpeg', 'webp'], key="crop_uploader")
     
@@ -367,6 +927,7 @@ with tab4:
 
     if crop_file:
         original_img = clean_image(crop_file)
+        if original_img is None: return
         w, h = original_img.size
         
         if not st.session_state['canvas_locked']:
@@ -377,7 +938,7 @@ with tab4:
             display_w = int(w * scale_factor)
             display_h = int(h * scale_factor)
             
-            preview_img = original_img.resize((display_w, display_h))
+            preview_img = preview_of(original_img, (display_w, display_h))
             st.image(preview_img, width=display_w, caption=f"预览效果 ({display_w} x {display_h})")
             
             st.write("---")
@@ -386,7 +947,7 @@ with tab4:
                 st.session_state['locked_scale'] = scale_factor
                 st.session_state['canvas_key'] = str(uuid.uuid4())
                 
-                img_b64 = image_to_base64(preview_img)
+                img_b64 = canvas_image_src(preview_img)
                 bg_json = {
                     "version": "4.4.0",
                     "objects": [
@@ -405,7 +966,7 @@ with tab4:
                 }
                 st.session_state['canvas_bg_json'] = bg_json
                 st.session_state['frozen_drawing'] = bg_json
-                st.rerun()
+                rerun_tool()
 
         else:
             c_tools, c_canvas = st.columns([1, 3])
@@ -421,7 +982,7 @@ with tab4:
                         "objects": st.session_state['canvas_bg_json']['objects'] + st.session_state['saved_rects']
                     }
                     st.session_state['canvas_key'] = str(uuid.uuid4())
-                    st.rerun()
+                    rerun_tool()
 
                 st.write("---")
                 if st.button("↩️ 撤销上一步", use_container_width=True):
@@ -432,7 +993,7 @@ with tab4:
                             "objects": st.session_state['canvas_bg_json']['objects'] + st.session_state['saved_rects']
                         }
                         st.session_state['canvas_key'] = str(uuid.uuid4()) 
-                        st.rerun()
+                        rerun_tool()
                     else:
                         st.toast("没有可以撤销的操作")
 
@@ -440,17 +1001,17 @@ with tab4:
                     st.session_state['saved_rects'] = []
                     st.session_state['frozen_drawing'] = st.session_state['canvas_bg_json']
                     st.session_state['canvas_key'] = str(uuid.uuid4())
-                    st.rerun()
+                    rerun_tool()
 
                 st.write("---")
                 if st.button("🔄 解锁重置", use_container_width=True):
                     st.session_state['canvas_locked'] = False
-                    st.rerun()
+                    rerun_tool()
 
             with c_canvas:
                 if st.session_state['canvas_bg_json'] is None:
                     st.error("状态丢失，请解锁重试")
-                    st.stop()
+                    return
                     
                 bg_w = st.session_state['canvas_bg_json']['objects'][0]['width']
                 bg_h = st.session_state['canvas_bg_json']['objects'][0]['height']
@@ -462,7 +1023,7 @@ with tab4:
                     stroke_color="#FF0000",
                     stroke_width=2,
                     background_image=None,
-                    initial_drawing=st.session_state['frozen_drawing'],
+                    initial_drawing=publish_canvas_assets(st.session_state['frozen_drawing']),
                     update_streamlit=True,
                     height=bg_h,
                     width=bg_w,
@@ -481,29 +1042,26 @@ with tab4:
             st.write(f"当前已选中 **{count}** 个区域")
             
             if count > 0:
+                boxes, names = [], []
+                scale = st.session_state['locked_scale']
+                for i, obj in enumerate(st.session_state['saved_rects']):
+                    real_x = int(obj["left"] / scale)
+                    real_y = int(obj["top"] / scale)
+                    real_w = int((obj["width"] * obj.get("scaleX", 1)) / scale)
+                    real_h = int((obj["height"] * obj.get("scaleY", 1)) / scale)
+                    if real_w > 0 and real_h > 0:
+                        boxes.append((real_x, real_y, real_x+real_w, real_y+real_h))
+                        names.append(f"crop_{i+1}.png")
+                crops_key = ('crops', upload_key(crop_file), tuple(boxes), tuple(names))
                 if st.button(f"✂️ 切割并下载这 {count} 张图", type="primary"):
-                    zip_buffer = io.BytesIO()
-                    with zipfile.ZipFile(zip_buffer, "w") as zf:
-                        scale = st.session_state['locked_scale']
-                        for i, obj in enumerate(st.session_state['saved_rects']):
-                            real_x = int(obj["left"] / scale)
-                            real_y = int(obj["top"] / scale)
-                            real_w = int((obj["width"] * obj.get("scaleX", 1)) / scale)
-                            real_h = int((obj["height"] * obj.get("scaleY", 1)) / scale)
-                            
-                            if real_w > 0 and real_h > 0:
-                                box = (real_x, real_y, real_x+real_w, real_y+real_h)
-                                try:
-                                    cropped = original_img.crop(box)
-                                    img_byte = io.BytesIO()
-                                    cropped.save(img_byte, format='PNG')
-                                    zf.writestr(f"crop_{i+1}.png", img_byte.getvalue())
-                                except: pass
-                                    
-                    st.download_button("📦 下载ZIP", zip_buffer.getvalue(), "free_crops.zip", "application/zip")
+                    export_crops_zip(original_img, 'crops_job', crops_key, boxes, names, "框选打包")
+                zip_download_ui('crops_job', crops_key, "free_crops.zip")
+
+with tab4: crop_tool()
 
 # --- Tab 5: 自由画布/拖拽拼图 ---
-with tab5:
+@tool_fragment('tab5')
+def canvas_tool():
     st.header("🎨 自由画布 (Free Canvas)")
     st.markdown("像PPT一样**拖拽、缩放、旋转**图片，自由组合。")
     free_files = st.file_uploader("上传素材图片", type=['png','jpg','jpeg','webp'], accept_multiple_files=True, key="free_canvas_up")
@@ -514,33 +1072,29 @@ with tab5:
         ch = c2.number_input("画布高度", 500, 3000, 600)
         bg = c3.color_picker("画布背景", "#FFFFFF")
         
-        if 'canvas_objects' not in st.session_state or st.session_state.get('last_uploaded_files') != free_files:
-            initial_json = {"version": "4.4.0", "objects": []}
-            for idx, f in enumerate(free_files):
-                img = clean_image(f)
-                if img.width > 400:
-                    ratio = 400 / img.width
-                    img = img.resize((400, int(img.height * ratio)))
-                img_b64 = image_to_base64(img)
-                obj = {
-                    "type": "image", "version": "4.4.0", "originX": "left", "originY": "top",
-                    "left": 50 + (idx * 30), "top": 50 + (idx * 30),
-                    "width": img.width, "height": img.height,
-                    "fill": "rgb(0,0,0)", "stroke": None, "strokeWidth": 0,
-                    "scaleX": 1, "scaleY": 1, "angle": 0, "flipX": False, "flipY": False,
-                    "opacity": 1, "visible": True, "backgroundColor": "",
-                    "src": img_b64, "selectable": True, "evented": True
-                }
-                initial_json["objects"].append(obj)
-            st.session_state['canvas_json'] = initial_json
-            st.session_state['last_uploaded_files'] = free_files
+        item_keys = [(f.file_id, f.size) for f in free_files]
+        if st.session_state.get('canvas_item_files') != item_keys:
+            with span('canvas_sync'):
+                # 以画布上最新的布局为基础，只增删变化的素材
+                objects = st.session_state.get('canvas_latest_objects', st.session_state.get('canvas_json', {}).get('objects', []))
+                objects, items, sources = sync_canvas_objects(free_files, objects, st.session_state.get('canvas_items', {}))
+            st.session_state['canvas_json'] = {"version": "4.4.0", "objects": objects}
+            st.session_state['canvas_items'], st.session_state['canvas_sources'] = items, sources
+            st.session_state['canvas_item_files'] = item_keys
+            st.session_state['canvas_pending'] = canvas_object_assets(objects)
 
         canvas_result = st_canvas(
             fill_color=bg, stroke_color="rgba(0, 0, 0, 0)", background_color=bg, background_image=None,
             update_streamlit=True, height=ch, width=cw, drawing_mode="transform",
-            initial_drawing=st.session_state['canvas_json'], key="free_canvas_board", display_toolbar=True
+            initial_drawing=publish_canvas_assets(st.session_state['canvas_json']), key="free_canvas_board", display_toolbar=True
         )
         st.caption("提示：点击图片选中，Delete键删除，拖动边框缩放/旋转。")
+        if canvas_result.json_data is not None:
+            # 重建后组件可能还返回旧布局，等它载入新的对象列表后再采用
+            latest = canvas_result.json_data["objects"]
+            pending = st.session_state.get('canvas_pending')
+            if pending is None or canvas_object_assets(latest) == pending:
+                st.session_state['canvas_latest_objects'], st.session_state['canvas_pending'] = latest, None
         
         if canvas_result.image_data is not None:
             result_image = Image.fromarray(canvas_result.image_data.astype('uint8'), 'RGBA')
@@ -551,3 +1105,37 @@ with tab5:
                 buf = io.BytesIO()
                 result_image.save(buf, format="PNG")
                 st.download_button("📥 下载设计图", data=buf.getvalue(), file_name="my_design.png", mime="image/png", type="primary")
+
+        if canvas_result.json_data is not None:
+            st.divider()
+            st.markdown("**原图渲染导出**（用原始分辨率的图片按画布布局重新合成）")
+            r1, r2 = st.columns([1, 2])
+            out_scale = r1.number_input("输出倍率", 0.5, 10.0, 2.0, 0.5, key="free_render_scale")
+            out_w, out_h = canvas_render.output_size((cw, ch), out_scale)
+            r2.caption(f"输出尺寸: {out_w} x {out_h}")
+            if st.button("🖨️ 原图渲染", key="free_render_btn"):
+                objects, sources = canvas_result.json_data["objects"], st.session_state.get('canvas_sources', {})
+                skipped = unresolved_objects(objects, sources)
+                if skipped: st.warning(f"有 {skipped} 个对象找不到原图，已跳过")
+                # 任务线程只拿到用到的原图副本；key 由布局与素材哈希决定，相同布局直接复用结果
+                used = {k: io.BytesIO(sources[k].getvalue()) for k in canvas_object_assets(objects) if k in sources}
+                digest = hashlib.blake2b(json.dumps([objects, (cw, ch), bg, out_scale], sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+                submit_job('free_render_job', ('free_render', digest), "原图渲染", _free_render_job, get_result_store(),
+                           objects, used, (cw, ch), bg, out_scale)
+            job = job_status_ui('free_render_job')
+            if job is not None:
+                set_session_result('free_render', job.result)
+                del st.session_state['free_render_job']
+            rendered = session_result('free_render', "渲染")
+            if isinstance(rendered, StreamedStitch):
+                st.image(rendered.preview, caption=f"渲染结果 {rendered.width} x {rendered.height}（缩略图）", use_column_width=True)
+                streamed_download_ui(rendered, "my_design_full", "free_stream", "📥 下载原图渲染")
+            elif rendered is not None:
+                st.image(rendered.view(fit_size(rendered.size, 1600)), caption=f"渲染结果 {rendered.width} x {rendered.height}", use_column_width=True)
+                export_image_ui(rendered, "my_design_full", "free_export", "📥 下载原图渲染")
+
+with tab5: canvas_tool()
+
+# === 缓存与耗时指标导出（供 Prometheus node_exporter textfile 采集） ===
+finish_run(_rerun_spans)
+if DEBUG_PANEL or st.query_params.get('debug') == '1': render_debug_panel(_rerun_spans)
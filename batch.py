@@ -0,0 +1,272 @@
+"""批处理命令行：不经过浏览器，在进程池里批量拼接 / 切片 / 增强。
+
+    python batch.py stitch 相册/* -o out --mode grid --cols 3        # 每个目录拼成一张
+    python batch.py slice 图片目录 -o out --x 500,1000 --y 800        # 按参考线切片
+    python batch.py slice 图片目录 -o out --grid 3x2                   # 均分切片
+    python batch.py enhance 图片目录 -o out --upscale 2 -j 4          # 逐张增强
+    python batch.py run jobs.jsonl -o out                             # 清单，每行一个任务
+
+清单每行是一个 JSON 对象，op 为 stitch / slice / enhance，inputs 为文件或目录列表，
+其余字段与对应子命令的参数同名，例如
+    {"op": "stitch", "inputs": ["a.jpg", "b.jpg"], "output": "ab.png", "mode": "horizontal"}
+
+每个任务完成后输出一行耗时；退出码：0 全部成功，1 有任务失败，2 参数或清单错误，
+3 没有找到输入，130 被中断。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+import image_core
+import image_export
+
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff')
+EXIT_OK, EXIT_FAILED, EXIT_USAGE, EXIT_NO_INPUT, EXIT_INTERRUPTED = 0, 1, 2, 3, 130
+Image.MAX_IMAGE_PIXELS = None
+
+
+def list_images(path):
+    """目录按文件名排序返回其中的图片，文件原样返回，不存在的路径提示后跳过"""
+    if not os.path.exists(path):
+        print(f"找不到 {path}", file=sys.stderr)
+        return []
+    if os.path.isdir(path):
+        return [os.path.join(path, n) for n in sorted(os.listdir(path)) if n.lower().endswith(IMAGE_EXTS)]
+    return [path]
+
+
+def _decode(path):
+    # 批处理中解码失败应当算作任务失败，不使用界面里的占位图
+    with open(path, 'rb') as fp: data = fp.read()
+    try: return image_core.decode_image_bytes(data, strict=True)
+    except Exception as e: raise ValueError(f"无法解码 {path}: {e}") from e
+
+
+def _save(img, path, fmt, preset):
+    """先写临时文件再改名，中断时不会留下半个输出"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.part'
+    with open(tmp, 'wb') as fp: fp.write(image_export.encode_image(img, fmt, preset).data)
+    os.replace(tmp, path)
+    return path
+
+
+def _ext(fmt):
+    return image_export.FORMATS['JPEG' if fmt.upper() == 'JPG' else fmt.upper()][1]
+
+
+def _parse_guides(value):
+    return [int(v) for v in str(value).split(',') if v.strip()] if value not in (None, '') else []
+
+
+def _grid_guides(size, grid):
+    cols, rows = (int(v) for v in grid.lower().split('x'))
+    return [size[0] * i // cols for i in range(1, cols)], [size[1] * j // rows for j in range(1, rows)]
+
+
+# --- 任务：在子进程中执行，返回输出文件列表 ---
+
+def job_stitch(inputs, output, mode='vertical', align='max', cols=2, padding=0, bg='#FFFFFF', fmt='png', preset='balanced', **_):
+    # 流式拼接：布局只读文件头，输入逐张解码后落盘，输出按条带编码，内存占用与输入张数无关
+    items = [{'file': p, 'scale': 1.0, 'rotate': 0} for p in inputs]
+    out_dir = os.path.dirname(output) or '.'
+    os.makedirs(out_dir, exist_ok=True)
+    res = image_core.stitch_images_streaming(items, mode, align, int(cols), int(padding), bg, load=_decode, directory=out_dir,
+                                             png_level=image_export.SAVE_OPTIONS['PNG'][preset]['compress_level'])
+    if _ext(fmt) == 'png':
+        os.replace(res.path, output)
+        return [output]
+    # JPEG / WebP 需要整图编码，从流式结果读回一次
+    with Image.open(res.path) as im: result = im.convert('RGB')
+    res.discard()
+    return [_save(result, output, fmt, preset)]
+
+
+def job_slice(inputs, output, x=None, y=None, grid=None, fmt='png', preset='balanced', **_):
+    img = _decode(inputs[0])
+    xs, ys = _grid_guides(img.size, grid) if grid else (_parse_guides(x), _parse_guides(y))
+    stem = os.path.splitext(output)[0]
+    return [_save(tile, f"{stem}_{i + 1}.{_ext(fmt)}", fmt, preset) for i, tile in enumerate(image_core.slice_image_by_guides(img, xs, ys))]
+
+
+def job_enhance(inputs, output, upscale=2.0, sharpness=2.0, contrast=1.1, color=1.1, engine='pil', fmt='png', preset='balanced', **_):
+    # 任务之间已经并行，单个任务内不再开分块进程池
+    result = image_core.enhance_image(_decode(inputs[0]), float(upscale), float(sharpness), float(contrast), float(color),
+                                      tiled=False, engine=engine)
+    return [_save(result, output, fmt, preset)]
+
+
+JOBS = {'stitch': job_stitch, 'slice': job_slice, 'enhance': job_enhance}
+
+
+def _run_job(job):
+    t = time.perf_counter()
+    outputs = JOBS[job['op']](**job)
+    return outputs, time.perf_counter() - t
+
+
+# --- 生成任务 ---
+
+def _job(op, inputs, out_dir, name, opts):
+    fmt = opts.get('fmt', 'png')
+    # 清单里的相对 output 也放在输出目录下
+    output = os.path.join(out_dir, opts.get('output') or f"{name}.{_ext(fmt)}")
+    return dict(opts, op=op, inputs=inputs, output=output, fmt=fmt)
+
+
+def _stem(op, path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return stem + '_enhanced' if op == 'enhance' else stem
+
+
+def jobs_from_args(args):
+    opts = {k: v for k, v in vars(args).items() if v is not None and k not in ('command', 'paths', 'out', 'jobs', 'skip_existing', 'report')}
+    jobs = []
+    if args.command == 'stitch':
+        # 每个目录拼成一张；直接给出的文件合在一起拼成一张
+        files = [f for p in args.paths if not os.path.isdir(p) for f in list_images(p)]
+        for d in (p for p in args.paths if os.path.isdir(p)):
+            images = list_images(d)
+            if images: jobs.append(_job('stitch', images, args.out, os.path.basename(os.path.normpath(d)), opts))
+        if files: jobs.append(_job('stitch', files, args.out, 'stitched', opts))
+    else:
+        for p in args.paths:
+            for f in list_images(p): jobs.append(_job(args.command, [f], args.out, _stem(args.command, f), opts))
+    return jobs
+
+
+def jobs_from_manifest(path, out_dir, defaults):
+    """defaults 为命令行给出的 --format/--preset，清单里的同名字段优先"""
+    jobs = []
+    with open(path, encoding='utf-8') as fp:
+        for n, line in enumerate(fp, 1):
+            if not line.strip() or line.lstrip().startswith('#'): continue
+            try:
+                spec = json.loads(line)
+                if 'format' in spec: spec['fmt'] = spec.pop('format')
+                spec = dict(defaults, **spec)
+                op = spec.pop('op')
+                if op not in JOBS: raise ValueError(f"unknown op {op!r}")
+                inputs = [f for p in spec.pop('inputs') for f in list_images(p)]
+                if not inputs: raise ValueError("no input images")
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"{path}:{n}: {e}") from e
+            name = _stem(op, inputs[0]) if op != 'stitch' else f"job{n}"
+            jobs.append(_job(op, inputs, out_dir, name, spec))
+    return jobs
+
+
+# --- 执行 ---
+
+def run_jobs(jobs, workers, skip_existing=False, log=sys.stderr):
+    """在进程池中执行任务，同时提交的任务数有上限（每个子进程最多两个），返回每个任务的结果记录"""
+    records, pending = [], {}
+    todo = iter(jobs)
+    ctx = multiprocessing.get_context('spawn')
+    # 子进程定期重建，长时间运行时碎片化的内存不会一直累积
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, max_tasks_per_child=50) as pool:
+        def submit():
+            for job in todo:
+                if skip_existing and job['op'] != 'slice' and os.path.exists(job['output']):
+                    records.append({'op': job['op'], 'inputs': job['inputs'], 'status': 'skipped', 'outputs': [job['output']], 'seconds': 0.0})
+                    print(f"skip  {'':>8} {job['output']}", file=log)
+                    continue
+                pending[pool.submit(_run_job, job)] = job
+                return True
+            return False
+        while len(pending) < workers * 2 and submit(): pass
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                job = pending.pop(fut)
+                try:
+                    outputs, seconds = fut.result()
+                    records.append({'op': job['op'], 'inputs': job['inputs'], 'status': 'ok', 'outputs': outputs, 'seconds': round(seconds, 3)})
+                    print(f"ok    {seconds:>7.2f}s {job['op']} {len(job['inputs'])} -> {', '.join(outputs) if len(outputs) < 4 else f'{len(outputs)} files'}", file=log)
+                except Exception as e:
+                    records.append({'op': job['op'], 'inputs': job['inputs'], 'status': 'failed', 'error': f"{type(e).__name__}: {e}"})
+                    print(f"FAIL  {'':>8} {job['op']} {job['inputs'][0]}: {type(e).__name__}: {e}", file=log)
+                submit()
+    return records
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="图片工具箱批处理")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-o', '--out', default='out', help="输出目录（默认 out）")
+    common.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="并行进程数")
+    common.add_argument('--format', dest='fmt', choices=['png', 'jpeg', 'webp'], help="输出格式（默认 png）")
+    common.add_argument('--preset', choices=image_export.PRESETS, help="压缩预设（默认 balanced）")
+    common.add_argument('--skip-existing', action='store_true', help="输出已存在时跳过（用于中断后续跑）")
+    common.add_argument('--report', help="把每个任务的结果写成 JSON")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('stitch', parents=[common], help="每个目录拼成一张图")
+    p.add_argument('paths', nargs='+')
+    p.add_argument('--mode', choices=['vertical', 'horizontal', 'grid'])
+    p.add_argument('--align', choices=['max', 'original'])
+    p.add_argument('--cols', type=int)
+    p.add_argument('--padding', type=int)
+    p.add_argument('--bg', help="背景色，如 #FFFFFF")
+
+    p = sub.add_parser('slice', parents=[common], help="按参考线切片")
+    p.add_argument('paths', nargs='+')
+    p.add_argument('--x', help="垂直参考线，逗号分隔的像素坐标")
+    p.add_argument('--y', help="水平参考线，逗号分隔的像素坐标")
+    p.add_argument('--grid', help="均分为 列x行，如 3x2")
+
+    p = sub.add_parser('enhance', parents=[common], help="逐张高清修复")
+    p.add_argument('paths', nargs='+')
+    p.add_argument('--upscale', type=float)
+    p.add_argument('--sharpness', type=float)
+    p.add_argument('--contrast', type=float)
+    p.add_argument('--color', type=float)
+    p.add_argument('--engine', choices=['pil', 'numpy'])
+
+    p = sub.add_parser('run', parents=[common], help="执行 JSONL 任务清单")
+    p.add_argument('manifest')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'slice' and not (args.x or args.y or args.grid):
+        print("slice 需要 --x/--y 或 --grid", file=sys.stderr)
+        return EXIT_USAGE
+    try:
+        if args.command == 'run':
+            defaults = {k: getattr(args, k) for k in ('fmt', 'preset') if getattr(args, k)}
+            jobs = jobs_from_manifest(args.manifest, args.out, defaults)
+        else:
+            jobs = jobs_from_args(args)
+    except (ValueError, OSError) as e:
+        print(e, file=sys.stderr)
+        return EXIT_USAGE
+    if not jobs:
+        print("没有找到输入图片", file=sys.stderr)
+        return EXIT_NO_INPUT
+    t = time.perf_counter()
+    try:
+        records = run_jobs(jobs, max(1, args.jobs), args.skip_existing)
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+    except BrokenProcessPool as e:
+        # 子进程被系统杀掉（通常是内存不足），已完成的输出保留，可用 --skip-existing 续跑
+        print(f"进程池异常退出: {e}", file=sys.stderr)
+        return EXIT_FAILED
+    failed = sum(r['status'] == 'failed' for r in records)
+    print(f"{len(records) - failed}/{len(records)} 个任务完成，{failed} 个失败，共 {time.perf_counter() - t:.1f}s", file=sys.stderr)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as fp: json.dump(records, fp, ensure_ascii=False, indent=1)
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
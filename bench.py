@@ -0,0 +1,243 @@
+"""热点路径基准：合成输入，记录耗时与峰值内存，输出 JSON 报告并与基线比较。
+
+    python bench.py                                   # quick 档，结果打印到终端
+    python bench.py --profile full -o bench.json      # 1~200 MP、N 至 500 的完整档
+    python bench.py -k stitch --baseline bench.json   # 只跑名字含 stitch 的用例并与基线比较
+
+每个用例在独立的 spawn 子进程中运行：先生成输入（不计时），再重置 VmHWM（Linux），
+计时运行 repeat 次取最快一次。peak_rss_mb 为运行期间 RSS 峰值相对运行前的增量，
+tracemalloc_mb 只统计 Python 分配（Pillow 的像素缓冲不在其中）。
+与基线比较时耗时或峰值 RSS 超过 --threshold 倍的用例记为回归，退出码为 1。
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import queue as queue_mod
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import PIL
+from PIL import Image
+
+import image_core
+from instrument import reset_peak_rss, rss_kb
+
+SEED = 20240601
+
+
+# --- 合成输入 ---
+
+def synth_rgb(mp, seed=SEED, aspect=4 / 3):
+    """确定性的渐变 + 噪声图，压缩率接近照片"""
+    h = max(1, int((mp * 1e6 / aspect) ** 0.5))
+    w = max(1, int(mp * 1e6 / h))
+    rng = np.random.default_rng(seed)
+    img = np.empty((h, w, 3), np.uint8)
+    xs = np.linspace(0, 255, w, dtype=np.float32)
+    for y0 in range(0, h, 512):
+        y1 = min(h, y0 + 512)
+        ys = np.linspace(y0, y1 - 1, y1 - y0, dtype=np.float32)[:, None] * (255 / h)
+        band = np.stack(np.broadcast_arrays(xs * 0.9, ys * 0.9, (xs + ys) * 0.45), axis=-1)
+        band = band + rng.integers(0, 24, (y1 - y0, w, 3), dtype=np.uint8)
+        img[y0:y1] = band.astype(np.uint8)
+    return Image.fromarray(img, 'RGB')
+
+
+def synth_variant(img, kind):
+    """RGB / RGBA / 带透明色的 P / EXIF 旋转的 JPEG，返回编码后的字节"""
+    buf = io.BytesIO()
+    if kind == 'rgba':
+        rgba = img.convert('RGBA')
+        rgba.putalpha(img.convert('L'))
+        rgba.save(buf, 'PNG', compress_level=1)
+    elif kind == 'p':
+        img.quantize(64).save(buf, 'PNG', transparency=0, compress_level=1)
+    elif kind == 'jpeg_exif':
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        img.save(buf, 'JPEG', quality=90, exif=exif)
+    else:
+        img.save(buf, 'PNG', compress_level=1)
+    return buf.getvalue()
+
+
+def synth_stitch_items(n, mp_each=0.25):
+    rng = np.random.default_rng(SEED + n)
+    base = synth_rgb(mp_each * 2)
+    items = []
+    for _ in range(n):
+        w = int(base.width * rng.uniform(0.5, 1.0))
+        h = int(base.height * rng.uniform(0.5, 1.0))
+        items.append({'img': base.crop((0, 0, w, h)), 'scale': 1.0, 'rotate': 0})
+    return items
+
+
+def grid_guides(size, n):
+    return [size[0] * i // (n + 1) for i in range(1, n + 1)], [size[1] * j // (n + 1) for j in range(1, n + 1)]
+
+
+# --- 用例：setup(params) 返回无参可调用对象 ---
+
+def setup_decode(mp, kind):
+    data = synth_variant(synth_rgb(mp), kind)
+    return lambda: image_core.process_uploaded_image(io.BytesIO(data))
+
+
+def setup_stitch(n, mode):
+    items = synth_stitch_items(n)
+    return lambda: image_core.stitch_images_advanced(items, mode, 'max', cols=max(1, int(n ** 0.5)), padding=4)
+
+
+def setup_slice(mp, guides):
+    img = synth_rgb(mp)
+    xs, ys = grid_guides(img.size, guides)
+    return lambda: image_core.slice_image_by_guides(img, xs, ys)
+
+
+def setup_enhance(mp, upscale, engine):
+    img = synth_rgb(mp)
+    return lambda: image_core.enhance_image(img, upscale, tiled=False, engine=engine)
+
+
+def setup_zip(mp, guides):
+    img = synth_rgb(mp)
+    boxes = image_core.guide_boxes(img.size, *grid_guides(img.size, guides))
+    names = [f"slice_{i + 1}.png" for i in range(len(boxes))]
+    return lambda: image_core.build_crops_zip(img, boxes, names).close()
+
+
+def setup_base64(mp):
+    img = synth_rgb(mp)
+    return lambda: image_core.image_to_base64(img)
+
+
+SETUPS = {'decode': setup_decode, 'stitch': setup_stitch, 'slice': setup_slice, 'enhance': setup_enhance,
+          'zip': setup_zip, 'base64': setup_base64}
+
+
+def cases(profile):
+    """返回 [(名称, setup 名, 参数)]，full 档覆盖 200 MP 与 N=500"""
+    full = profile == 'full'
+    out = []
+    for mp in (1, 12, 50, 200) if full else (1, 4):
+        for kind in ('rgb', 'rgba', 'p', 'jpeg_exif'):
+            if kind == 'p' and mp > 50: continue  # quantize 生成输入过慢
+            out.append((f"decode/{kind}/{mp}mp", 'decode', {'mp': mp, 'kind': kind}))
+    for n in (2, 20, 100, 500) if full else (2, 20, 100):
+        for mode in ('vertical', 'horizontal', 'grid'):
+            out.append((f"stitch/{mode}/n{n}", 'stitch', {'n': n, 'mode': mode}))
+    for guides in (10, 50, 100) if full else (10, 50):
+        out.append((f"slice/24mp/g{guides}", 'slice', {'mp': 24, 'guides': guides}))
+    for mp in (1, 12) if full else (1, 4):
+        for upscale in (1.0, 2.0):
+            for engine in ('pil', 'numpy'):
+                out.append((f"enhance/{engine}/x{upscale:g}/{mp}mp", 'enhance', {'mp': mp, 'upscale': upscale, 'engine': engine}))
+    for guides in (5, 20) if full else (5,):
+        out.append((f"zip/12mp/g{guides}", 'zip', {'mp': 12, 'guides': guides}))
+    for mp in (1, 12) if full else (1, 4):
+        out.append((f"base64/{mp}mp", 'base64', {'mp': mp}))
+    return out
+
+
+# --- 测量 ---
+
+def _measure(setup, params, repeat, queue):
+    try:
+        fn = SETUPS[setup](**params)
+        times, rss, traced, can_reset = [], 0.0, 0.0, False
+        for _ in range(repeat):
+            can_reset = reset_peak_rss()
+            base = rss_kb('VmRSS')
+            tracemalloc.start()
+            t = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t)
+            traced = max(traced, tracemalloc.get_traced_memory()[1] / 2 ** 20)
+            tracemalloc.stop()
+            if can_reset: rss = max(rss, (rss_kb('VmHWM') - base) / 1024)
+        queue.put({'seconds': min(times), 'seconds_all': [round(t, 4) for t in times],
+                   'peak_rss_mb': round(rss, 1) if can_reset else None, 'tracemalloc_mb': round(traced, 1)})
+    except Exception as e:
+        queue.put({'error': f"{type(e).__name__}: {e}"})
+
+
+def run_case(setup, params, repeat):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_measure, args=(setup, params, repeat, queue))
+    proc.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except queue_mod.Empty:
+            # 子进程被杀（如内存不足）时不会有结果
+            if not proc.is_alive():
+                result = {'error': f"worker exited with code {proc.exitcode}"}
+                break
+    proc.join()
+    return result
+
+
+def environment(profile):
+    return {'python': platform.python_version(), 'pillow': PIL.__version__, 'numpy': np.__version__,
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'profile': profile,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(results, baseline, threshold):
+    """返回 [(名称, 指标, 基线, 当前, 比值)] 中超过阈值的回归项"""
+    regressions = []
+    for name, cur in results.items():
+        old = baseline.get(name)
+        if not old or 'error' in cur or 'error' in old: continue
+        for metric in ('seconds', 'peak_rss_mb'):
+            a, b = old.get(metric), cur.get(metric)
+            # 太小的值受噪声影响大，不参与比较
+            floor = 0.005 if metric == 'seconds' else 8
+            if a and b and max(a, b) >= floor and b / a > threshold: regressions.append((name, metric, a, b, b / a))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="图片工具箱热点路径基准")
+    parser.add_argument('--profile', choices=['quick', 'full'], default='quick')
+    parser.add_argument('-k', dest='filter', help="只运行名称包含该子串的用例")
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--out', help="把报告写成 JSON")
+    parser.add_argument('--baseline', help="与之前保存的 JSON 报告比较")
+    parser.add_argument('--threshold', type=float, default=1.25, help="耗时/峰值内存超过基线的倍数视为回归")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as fp: baseline = json.load(fp)['results']
+    results = {}
+    print(f"{'case':<34} {'seconds':>9} {'rss MB':>8} {'py MB':>7} {'vs base':>8}")
+    for name, setup, params in cases(args.profile):
+        if args.filter and args.filter not in name: continue
+        r = results[name] = dict(run_case(setup, params, args.repeat), params=params)
+        if 'error' in r:
+            print(f"{name:<34} {r['error']}")
+            continue
+        old = baseline.get(name, {}).get('seconds')
+        ratio = f"{r['seconds'] / old:>7.2f}x" if old else ''
+        rss = f"{r['peak_rss_mb']:>8.0f}" if r['peak_rss_mb'] is not None else f"{'-':>8}"
+        print(f"{name:<34} {r['seconds']:>9.4f} {rss} {r['tracemalloc_mb']:>7.1f} {ratio:>8}", flush=True)
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as fp:
+            json.dump({'environment': environment(args.profile), 'results': results}, fp, indent=1, ensure_ascii=False)
+    if not baseline: return 0
+    regressions = compare(results, baseline, args.threshold)
+    for name, metric, a, b, ratio in regressions: print(f"REGRESSION {name} {metric}: {a} -> {b} ({ratio:.2f}x)")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+"""进程级缓存：解码结果、预览金字塔、记忆缓存、ZIP 归档、导出编码与画布素材。
+
+这些对象由 app.py 通过 st.cache_resource 各建一个实例，所有会话共享；类定义放在可导入的
+模块里，脚本每次重跑重新执行时类型保持不变。
+"""
+import hashlib
+import io
+import mmap
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+from PIL import Image
+
+from image_core import image_nbytes
+from instrument import prometheus_text
+
+PYRAMID_MIN_SIZE = 128
+
+
+class DecodedImageCache:
+    """进程级解码缓存。相同字节内容在所有会话间共享同一个 Image，调用方不得原地修改返回的图片。
+    内存超出 max_bytes 时淘汰最久未用的条目；设置了 spill_dir 时被淘汰的条目以 raw RGB 落盘，
+    再次命中时通过 mmap 读回。"""
+    def __init__(self, max_bytes, spill_dir=None, spill_max_bytes=0):
+        self.max_bytes, self.spill_dir, self.spill_max_bytes = max_bytes, spill_dir, spill_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = dict(hits=0, misses=0, evictions=0, spill_writes=0, spill_hits=0, spill_evictions=0)
+        if spill_dir: os.makedirs(spill_dir, exist_ok=True)
+
+    @staticmethod
+    def key_for(data):
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def get_or_create(self, key, factory):
+        with self._lock:
+            img = self._entries.get(key)
+            if img is not None:
+                self._entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return img
+        img = self._load_spilled(key)
+        if img is None:
+            img = factory()
+            with self._lock: self.counters['misses'] += 1
+        self._put(key, img)
+        return img
+
+    def _put(self, key, img):
+        nbytes = image_nbytes(img)
+        evicted = []
+        with self._lock:
+            if key in self._entries or nbytes > self.max_bytes: return
+            self._entries[key] = img
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                old_key, old_img = self._entries.popitem(last=False)
+                self._bytes -= image_nbytes(old_img)
+                self.counters['evictions'] += 1
+                evicted.append((old_key, old_img))
+        for old_key, old_img in evicted: self._spill(old_key, old_img)
+
+    def _spill(self, key, img):
+        if not self.spill_dir or img.mode != 'RGB': return
+        path = os.path.join(self.spill_dir, f"{key}_{img.width}x{img.height}.raw")
+        if not os.path.exists(path):
+            with open(path + '.tmp', 'wb') as fp: fp.write(img.tobytes())
+            os.replace(path + '.tmp', path)
+            with self._lock: self.counters['spill_writes'] += 1
+        self._trim_spill()
+
+    def _trim_spill(self):
+        files = [os.path.join(self.spill_dir, n) for n in os.listdir(self.spill_dir) if n.endswith('.raw')]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(p) for p in files)
+        while files and total > self.spill_max_bytes:
+            p = files.pop(0)
+            total -= os.path.getsize(p)
+            try: os.remove(p)
+            except OSError: continue
+            with self._lock: self.counters['spill_evictions'] += 1
+
+    def _load_spilled(self, key):
+        if not self.spill_dir: return None
+        names = [n for n in os.listdir(self.spill_dir) if n.startswith(key + '_') and n.endswith('.raw')]
+        if not names: return None
+        path = os.path.join(self.spill_dir, names[0])
+        try:
+            w, h = map(int, names[0][len(key) + 1:-4].split('x'))
+            with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                img = Image.frombytes('RGB', (w, h), mm)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        with self._lock: self.counters['spill_hits'] += 1
+        return img
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
+
+    def prometheus_text(self):
+        return prometheus_text('decode_cache', self.stats(), self.counters)
+
+
+class PreviewPyramid:
+    """原图只以弱引用持有，金字塔本身不会延长原图的生命周期"""
+    def __init__(self, img):
+        self._base = weakref.ref(img)
+        self._reduced = []
+        self._lock = threading.Lock()
+
+    def level_for(self, size):
+        """返回不小于 size 的最小级别，按需继续 reduce"""
+        base = self._base()
+        with self._lock:
+            while True:
+                last = self._reduced[-1] if self._reduced else base
+                if last.width < 2 * size[0] or last.height < 2 * size[1] or min(last.size) < 2 * PYRAMID_MIN_SIZE:
+                    break
+                self._reduced.append(last.reduce(2))
+            for level in reversed(self._reduced):
+                if level.width >= size[0] and level.height >= size[1]: return level
+        return base
+
+    def get(self, size, shared=False):
+        """shared=True 时尺寸正好等于某一级别就直接返回该级别（只读）"""
+        size = (max(1, int(size[0])), max(1, int(size[1])))
+        level = self.level_for(size)
+        if level.size == size: return level if shared else level.copy()
+        return level.resize(size)
+
+
+class PyramidRegistry:
+    """按 Image 对象登记金字塔，原图被回收（如被解码缓存淘汰）时金字塔随之释放"""
+    def __init__(self):
+        self._pyramids = {}
+        self._lock = threading.Lock()
+
+    def get(self, img):
+        with self._lock:
+            pyramid = self._pyramids.get(id(img))
+            if pyramid is None or pyramid._base() is not img:
+                pyramid = self._pyramids[id(img)] = PreviewPyramid(img)
+                weakref.finalize(img, self._pyramids.pop, id(img), None)
+            return pyramid
+
+
+class MemoCache:
+    """按条目数做 LRU 的进程级记忆缓存，多个会话并发访问时加锁；计算在锁外进行"""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, factory):
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None:
+                self._entries.move_to_end(key)
+                return hit
+        hit = factory()
+        with self._lock:
+            self._entries[key] = hit
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+        return hit
+
+
+class ArchiveCache:
+    """已生成的 ZIP 归档，按 key 做 LRU，淘汰时关闭（删除）对应临时文件。
+    全局锁只保护索引，读文件只持有该归档自己的锁"""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # key -> (fp, lock)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock: return key in self._entries
+
+    def get(self, key):
+        """读出归档字节，只在用户点击准备下载时调用；已淘汰时返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            self._entries.move_to_end(key)
+        fp, lock = entry
+        with lock:
+            if fp.closed: return None
+            fp.seek(0)
+            return fp.read()
+
+    def put(self, key, fp):
+        with self._lock:
+            self._entries[key] = (fp, threading.Lock())
+            self._entries.move_to_end(key)
+            evicted = [self._entries.popitem(last=False)[1] for _ in range(len(self._entries) - self.max_entries)]
+        for old, lock in evicted:
+            with lock: old.close()
+
+
+class EncodedRegistry:
+    """编码结果按字节数做 LRU；原图被回收（结果被替换）时对应条目立即释放"""
+    def __init__(self, max_bytes):
+        self.max_bytes, self.total = max_bytes, 0
+        self._entries = OrderedDict()
+        self._refs = {}
+        # finalize 回调可能在持锁期间由 GC 触发，用可重入锁
+        self._lock = threading.RLock()
+
+    def _drop_image(self, img_id):
+        with self._lock:
+            self._refs.pop(img_id, None)
+            for key in [k for k in self._entries if k[0] == img_id]: self.total -= len(self._entries.pop(key).data)
+
+    def get(self, img, fmt, preset):
+        with self._lock:
+            ref = self._refs.get(id(img))
+            if ref is None or ref() is not img: return None
+            enc = self._entries.get((id(img), fmt, preset))
+            if enc is not None: self._entries.move_to_end((id(img), fmt, preset))
+            return enc
+
+    def put(self, img, enc, preset):
+        with self._lock:
+            ref = self._refs.get(id(img))
+            if ref is None or ref() is not img:
+                self._refs[id(img)] = weakref.ref(img)
+                weakref.finalize(img, self._drop_image, id(img))
+            key = (id(img), enc.fmt, preset)
+            old = self._entries.pop(key, None)
+            if old is not None: self.total -= len(old.data)
+            self._entries[key] = enc
+            self.total += len(enc.data)
+            while self.total > self.max_bytes and len(self._entries) > 1: self.total -= len(self._entries.popitem(last=False)[1].data)
+        return enc
+
+
+class CanvasAssetStore:
+    """编码后的画布素材，按哈希做字节数 LRU；url -> 哈希 用于每次重跑重新登记，素材被淘汰时一并删除"""
+    def __init__(self, max_bytes, jpeg_quality=90):
+        self.max_bytes, self.total, self.jpeg_quality = max_bytes, 0, jpeg_quality
+        self._assets = OrderedDict()
+        self._urls = {}
+        self._lock = threading.Lock()
+
+    def add(self, img):
+        digest = hashlib.blake2b(f"{img.mode}{img.size}".encode(), digest_size=16)
+        digest.update(img.tobytes())
+        key = digest.hexdigest()
+        with self._lock:
+            if key in self._assets:
+                self._assets.move_to_end(key)
+                return key
+        buf = io.BytesIO()
+        if img.mode in ('RGBA', 'LA') or 'transparency' in img.info:
+            img.save(buf, format='PNG', compress_level=1); mime = 'image/png'
+        else:
+            img.convert('RGB').save(buf, format='JPEG', quality=self.jpeg_quality); mime = 'image/jpeg'
+        with self._lock:
+            self._assets[key] = (buf.getvalue(), mime)
+            self.total += len(buf.getvalue())
+            while self.total > self.max_bytes and len(self._assets) > 1:
+                old_key, (old_data, _) = self._assets.popitem(last=False)
+                self.total -= len(old_data)
+                for url in [u for u, k in self._urls.items() if k == old_key]: del self._urls[url]
+        return key
+
+    def get(self, key):
+        with self._lock: return self._assets.get(key)
+
+    def register_url(self, url, key):
+        with self._lock:
+            if key in self._assets: self._urls[url] = key
+
+    def key_for_url(self, url):
+        with self._lock: return self._urls.get(url)
@@ -0,0 +1,118 @@
+"""按 fabric.js 画布 JSON 在服务端用原图重新合成自由画布。
+
+每个图片对象的 left/top/originX/originY/scaleX/scaleY/angle/flipX/flipY/opacity
+换算成「原图像素 -> 输出像素」的仿射矩阵，只做一次仿射重采样（缩小超过 2 倍时先
+reduce() 预缩）。输出按行条带生成，每个条带只裁出对象落在条带内所需的原图区域，
+大海报不需要整幅 RGBA 缓冲。
+"""
+import math
+
+from PIL import Image
+
+BAND_ROWS = 1024
+RESAMPLE_MARGIN = 3   # BICUBIC 在源图上的支撑半径（含取整余量）
+_ORIGIN = {'left': 0.0, 'top': 0.0, 'center': 0.5, 'right': 1.0, 'bottom': 1.0}
+
+
+def _mul(m, n):
+    """两个 2x3 仿射矩阵相乘 (m ∘ n)"""
+    a, b, c, d, e, f = m
+    g, h, i, j, k, l = n
+    return (a * g + b * j, a * h + b * k, a * i + b * l + c,
+            d * g + e * j, d * h + e * k, d * i + e * l + f)
+
+
+def _inv(m):
+    a, b, c, d, e, f = m
+    det = a * e - b * d
+    return (e / det, -b / det, (b * f - c * e) / det, -d / det, a / det, (c * d - a * f) / det)
+
+
+def _apply(m, x, y):
+    return m[0] * x + m[1] * y + m[2], m[3] * x + m[4] * y + m[5]
+
+
+def object_matrix(obj, src_size, scale=1.0):
+    """原图像素坐标 -> 输出像素坐标，与 fabric calcTransformMatrix 一致"""
+    w, h = obj['width'], obj['height']
+    sx = obj.get('scaleX', 1) * (-1 if obj.get('flipX') else 1)
+    sy = obj.get('scaleY', 1) * (-1 if obj.get('flipY') else 1)
+    rad = math.radians(obj.get('angle', 0) or 0)
+    cos, sin = math.cos(rad), math.sin(rad)
+    # left/top 是 origin 点的位置，中心点 = origin 点 + 旋转后的 (缩放后尺寸 * 偏移)
+    ox = (0.5 - _ORIGIN[obj.get('originX', 'left')]) * w * abs(sx)
+    oy = (0.5 - _ORIGIN[obj.get('originY', 'top')]) * h * abs(sy)
+    cx, cy = obj['left'] + cos * ox - sin * oy, obj['top'] + sin * ox + cos * oy
+    to_local = (w / src_size[0], 0, -w / 2, 0, h / src_size[1], -h / 2)
+    to_canvas = (cos * sx, -sin * sy, cx, sin * sx, cos * sy, cy)
+    return _mul((scale, 0, 0, 0, scale, 0), _mul(to_canvas, to_local))
+
+
+def _bbox(m, size):
+    pts = [_apply(m, x, y) for x in (0, size[0]) for y in (0, size[1])]
+    xs, ys = [p[0] for p in pts], [p[1] for p in pts]
+    return math.floor(min(xs)), math.floor(min(ys)), math.ceil(max(xs)), math.ceil(max(ys))
+
+
+def _prepare(obj, img, scale):
+    """确定对象用到的源图（必要时 reduce 预缩）和最终仿射矩阵"""
+    m = object_matrix(obj, img.size, scale)
+    # 输出上每个源像素沿两轴的长度，缩小超过 2 倍时先按整数倍 reduce
+    fx = max(1, int(0.5 / max(math.hypot(m[0], m[3]), 1e-9)))
+    fy = max(1, int(0.5 / max(math.hypot(m[1], m[4]), 1e-9)))
+    if fx > 1 or fy > 1:
+        img = img.reduce((fx, fy))
+        m = _mul(m, (fx, 0, 0, 0, fy, 0))
+    if img.mode not in ('RGB', 'RGBA'): img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+    return img, m
+
+
+def _render_object(band, y0, img, m, opacity):
+    W, H = band.size
+    bx0, by0, bx1, by1 = _bbox(m, img.size)
+    bx0, by0, bx1, by1 = max(0, bx0), max(0, by0 - y0), min(W, bx1), min(H, by1 - y0)
+    if bx0 >= bx1 or by0 >= by1: return
+    inv = _inv(m)
+    # 条带内目标区域反算到源图，只裁出需要的部分
+    pts = [_apply(inv, x, y + y0) for x in (bx0, bx1) for y in (by0, by1)]
+    sx0 = max(0, math.floor(min(p[0] for p in pts)) - RESAMPLE_MARGIN)
+    sy0 = max(0, math.floor(min(p[1] for p in pts)) - RESAMPLE_MARGIN)
+    sx1 = min(img.width, math.ceil(max(p[0] for p in pts)) + RESAMPLE_MARGIN)
+    sy1 = min(img.height, math.ceil(max(p[1] for p in pts)) + RESAMPLE_MARGIN)
+    if sx0 >= sx1 or sy0 >= sy1: return
+    crop = img.crop((sx0, sy0, sx1, sy1))
+    if crop.mode != 'RGBA':
+        crop.putalpha(255)
+    # 目标区域只会采样到裁剪块内（含重采样余量），块外的透明只出现在对象轮廓之外
+    local = _mul((1, 0, -sx0, 0, 1, -sy0), _mul(inv, (1, 0, bx0, 0, 1, by0 + y0)))
+    out = crop.transform((bx1 - bx0, by1 - by0), Image.Transform.AFFINE, local, Image.Resampling.BICUBIC)
+    if opacity < 1:
+        out.putalpha(out.getchannel('A').point(lambda a: int(a * opacity + 0.5)))
+    band.paste(out, (bx0, by0), out)
+
+
+def render_bands(objects, resolve, canvas_size, bg_color=(255, 255, 255), scale=1.0, band_rows=BAND_ROWS):
+    """逐条带生成输出，yield (y0, RGB 条带)。resolve(obj) 返回对象对应的原图，None 表示跳过"""
+    W, H = output_size(canvas_size, scale)
+    prepared = []
+    for obj in objects:
+        if obj.get('type') != 'image' or not obj.get('visible', True): continue
+        img = resolve(obj)
+        if img is None: continue
+        img, m = _prepare(obj, img, scale)
+        prepared.append((img, m, float(obj.get('opacity', 1))))
+    for y0 in range(0, H, band_rows):
+        band = Image.new('RGB', (W, min(band_rows, H - y0)), bg_color)
+        for img, m, opacity in prepared: _render_object(band, y0, img, m, opacity)
+        yield y0, band
+
+
+def output_size(canvas_size, scale=1.0):
+    return max(1, round(canvas_size[0] * scale)), max(1, round(canvas_size[1] * scale))
+
+
+def render_canvas(objects, resolve, canvas_size, bg_color=(255, 255, 255), scale=1.0, band_rows=BAND_ROWS):
+    """在内存中合成整幅输出"""
+    result = Image.new('RGB', output_size(canvas_size, scale), bg_color)
+    for y0, band in render_bands(objects, resolve, canvas_size, bg_color, scale, band_rows): result.paste(band, (0, y0))
+    return result
@@ -0,0 +1,392 @@
+"""图片处理核心：解码、拼接、切片、增强、切片打包，不依赖 Streamlit。
+
+app.py 的界面与批处理命令行 batch.py 共用这里的实现。
+"""
+import base64
+import contextlib
+import io
+import math
+import os
+import struct
+import tempfile
+import weakref
+import zipfile
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+
+import numpy_enhance
+from instrument import traced
+import tiled_enhance
+
+TILED_ENHANCE_PIXELS = 16_000_000
+ZIP_SPOOL_BYTES = 32 * 1024 * 1024  # 超过该大小的 ZIP 转存到磁盘临时文件
+
+def parse_color(hex_color):
+    """'#RRGGBB' -> (r, g, b)"""
+    return tuple(int(hex_color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
+
+def image_nbytes(img):
+    return img.width * img.height * len(img.getbands())
+
+def remove_file(path):
+    try: os.remove(path)
+    except OSError: pass
+
+@traced('base64')
+def image_to_base64(img):
+    """将PIL图片转换为Base64字符串"""
+    buffered = io.BytesIO()
+    img.save(buffered, format="PNG")
+    img_str = base64.b64encode(buffered.getvalue()).decode()
+    return f"data:image/png;base64,{img_str}"
+
+@traced('decode')
+def decode_image_bytes(file_bytes, draft_size=None, strict=False):
+    """解码原始字节并统一为白底 RGB，失败时返回粉色占位图（strict=True 时抛出异常）。
+    给定 draft_size 时只生成不超过该尺寸的缩略图，JPEG 会直接以 1/2~1/8 比例解码。"""
+    try:
+        img = Image.open(io.BytesIO(file_bytes))
+        if draft_size:
+            # draft_size 以 EXIF 校正后的方向给出，方向 5~8 的原始像素宽高互换
+            if hasattr(img, 'getexif') and img.getexif().get(0x0112, 1) in (5, 6, 7, 8): draft_size = draft_size[::-1]
+            if img.format == 'JPEG': img.draft('RGB', draft_size)
+            img.thumbnail(draft_size)
+        try:
+            if hasattr(img, '_getexif'):
+                img = ImageOps.exif_transpose(img)
+        except: pass 
+        
+        new_img = Image.new("RGB", img.size, (255, 255, 255))
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            if img.mode != 'RGBA': img = img.convert('RGBA')
+            new_img.paste(img, mask=img.split()[3])
+        else:
+            new_img.paste(img)
+        return new_img
+    except Exception:
+        if strict: raise
+        return Image.new('RGB', (200, 50), (255, 200, 200))
+
+ImageProbe = namedtuple('ImageProbe', 'width height mode bands frames orientation format')
+_BYTES_PER_PIXEL = {'1': 1, 'L': 1, 'P': 1, 'LA': 2, 'PA': 2, 'I;16': 2, 'RGB': 3, 'YCbCr': 3, 'LAB': 3, 'HSV': 3}
+
+def probe_image(data):
+    """只读文件头：EXIF 校正后的尺寸、模式、帧数、方向，不解码像素"""
+    with Image.open(io.BytesIO(data)) as im:
+        orientation = im.getexif().get(0x0112, 1) if hasattr(im, 'getexif') else 1
+        w, h = im.size
+        if orientation in (5, 6, 7, 8): w, h = h, w
+        return ImageProbe(w, h, im.mode, len(im.getbands()), getattr(im, 'n_frames', 1), orientation, im.format)
+
+def _draft_scale(probe, draft_size):
+    # 与 JPEG draft() 相同：取不小于目标尺寸的最大 1/2^k 缩放
+    scale = 1
+    if probe.format == 'JPEG' and draft_size:
+        while scale < 8 and probe.width // (scale * 2) >= draft_size[0] and probe.height // (scale * 2) >= draft_size[1]: scale *= 2
+    return scale
+
+def estimate_decode_bytes(probe, draft_size=None):
+    """decode_image_bytes 的峰值内存估算：源缓冲 + EXIF 旋转副本 + RGBA 转换 + RGB 输出"""
+    scale = _draft_scale(probe, draft_size)
+    px = -(-probe.width // scale) * -(-probe.height // scale)
+    src = px * _BYTES_PER_PIXEL.get(probe.mode, 4)
+    peak = src * (2 if probe.orientation > 1 else 1)
+    if probe.mode in ('RGBA', 'LA', 'PA', 'P'): peak += px * 4
+    if draft_size:
+        ratio = min(1.0, draft_size[0] * scale / probe.width, draft_size[1] * scale / probe.height)
+        px = int(px * ratio * ratio)
+    return peak + px * 3
+
+def process_uploaded_image(uploaded_file, draft_size=None, cache=None, decoder=decode_image_bytes, key=None):
+    """uploaded_file 为任意可读文件对象；cache 为 DecodedImageCache 时按内容哈希复用解码结果。
+    decoder(data, draft_size) 可替换为带准入控制的解码函数；key 为调用方已知的内容哈希，命中时不读取文件"""
+    def read():
+        uploaded_file.seek(0)
+        return uploaded_file.read()
+    if cache is None: return decoder(read(), draft_size)
+    data = None
+    if key is None:
+        data = read()
+        key = cache.key_for(data)
+    if draft_size: key = f"{key}@{draft_size[0]}x{draft_size[1]}"
+    return cache.get_or_create(key, lambda: decoder(read() if data is None else data, draft_size))
+
+def wants_tiled(image, upscale_factor):
+    out_pixels = image.width * image.height * max(1.0, upscale_factor) ** 2
+    return out_pixels >= TILED_ENHANCE_PIXELS and tiled_enhance.supports(image, upscale_factor)
+
+@traced('enhance')
+def enhance_image(image, upscale_factor=2.0, sharpness=2.0, contrast=1.1, color=1.1, tiled=None, engine='pil', executor=None,
+                  progress=None):
+    """engine='numpy' 使用条带式 NumPy 融合实现（峰值内存更低，结果一致）；
+    分块计算使用 executor（进程池），为空时临时创建。progress(done, total) 只在 NumPy / 分块路径上调用"""
+    if engine == 'numpy':
+        return numpy_enhance.enhance_numpy(image, upscale_factor, sharpness, contrast, color, progress=progress)
+    if tiled is None: tiled = wants_tiled(image, upscale_factor)
+    if tiled:
+        return tiled_enhance.enhance_tiled(image, upscale_factor, sharpness, contrast, color, executor=executor, progress=progress)
+    return enhance_adjust(enhance_base(image, upscale_factor), sharpness, contrast, color)
+
+@traced('enhance_base')
+def enhance_base(image, upscale_factor=2.0):
+    """PIL 增强的第一阶段（放大 + USM），只取决于放大倍率，调整对比/色彩/锐化时可以复用"""
+    if upscale_factor > 1.0:
+        new_w, new_h = int(image.width * upscale_factor), int(image.height * upscale_factor)
+        image = image.resize((new_w, new_h), Image.Resampling.LANCZOS)
+    return image.filter(ImageFilter.UnsharpMask(radius=2, percent=150, threshold=3))
+
+@traced('enhance_adjust')
+def enhance_adjust(base, sharpness=2.0, contrast=1.1, color=1.1):
+    """第二阶段：对比度、色彩、锐度"""
+    img = ImageEnhance.Contrast(base).enhance(contrast)
+    img = ImageEnhance.Color(img).enhance(color)
+    return ImageEnhance.Sharpness(img).enhance(sharpness)
+
+def guide_boxes(size, xs, ys):
+    # 图外的参考线（如换了同名但更小的图片）不参与切割
+    xs = sorted(list(set([0] + [v for v in xs if 0 < v < size[0]] + [size[0]])))
+    ys = sorted(list(set([0] + [v for v in ys if 0 < v < size[1]] + [size[1]])))
+    return [(xs[i], ys[j], xs[i+1], ys[j+1]) for j in range(len(ys)-1) for i in range(len(xs)-1) if xs[i+1]>xs[i] and ys[j+1]>ys[j]]
+
+@traced('slice')
+def slice_image_by_guides(img, xs, ys):
+    return [img.crop(box) for box in guide_boxes(img.size, xs, ys)]
+
+# 拼接输入的 90/180/270 度旋转用无损 transpose，与 rotate(-角度, expand=True) 结果相同
+TRANSPOSE_FOR_ROTATE = {90: Image.Transpose.ROTATE_270, 180: Image.Transpose.ROTATE_180, 270: Image.Transpose.ROTATE_90}
+RESIZE_REDUCING_GAP = 3.0  # 缩小超过 3 倍时先按整数倍 reduce() 再 LANCZOS
+
+def transformed_size(size, scale, rotate):
+    """旋转、缩放后的尺寸，取整规则与原先逐步 rotate/resize 一致"""
+    w, h = size
+    if rotate in (90, 270): w, h = h, w
+    if scale != 1.0:
+        new_w, new_h = int(w * scale), int(h * scale)
+        if new_w > 0 and new_h > 0: w, h = new_w, new_h
+    return w, h
+
+def plan_stitch_layout(sizes, mode='vertical', alignment='max', cols=2, padding=0):
+    """按拼接规则计算布局（sizes 为旋转、缩放后的尺寸），返回 (画布尺寸, [(x, y, w, h), ...])"""
+    boxes = []
+    if mode == 'vertical':
+        max_width = max(w for w, h in sizes)
+        y_offset = 0
+        for w, h in sizes:
+            if alignment == 'max' and w != max_width:
+                ratio = max_width / w
+                w, h = max_width, int(h * ratio)
+            boxes.append(((max_width - w) // 2, y_offset, w, h))
+            y_offset += h + padding
+        return (max_width, y_offset - padding), boxes
+    if mode == 'horizontal':
+        max_height = max(h for w, h in sizes)
+        x_offset = 0
+        for w, h in sizes:
+            if alignment == 'max' and h != max_height:
+                ratio = max_height / h
+                w, h = int(w * ratio), max_height
+            boxes.append((x_offset, (max_height - h) // 2, w, h))
+            x_offset += w + padding
+        return (x_offset - padding, max_height), boxes
+    target_width = max(w for w, h in sizes)
+    resized = []
+    for w, h in sizes:
+        if alignment == 'max':
+            ratio = target_width / w
+            w, h = target_width, int(h * ratio)
+        resized.append((w, h))
+    rows = math.ceil(len(resized) / cols)
+    row_heights = [max(h for w, h in resized[r*cols:(r+1)*cols]) for r in range(rows)]
+    # 每行的起始 y 取前缀和，不再对每张图重复 sum(row_heights[:r])
+    row_tops = [0]
+    for row_h in row_heights: row_tops.append(row_tops[-1] + row_h + padding)
+    for i, (w, h) in enumerate(resized):
+        r, c = divmod(i, cols)
+        x = c * (target_width + padding) + (target_width - w) // 2
+        y = row_tops[r] + (row_heights[r] - h) // 2
+        boxes.append((x, y, w, h))
+    return (cols * target_width + (cols - 1) * padding, row_tops[-1] - padding), boxes
+
+def transform_input(img, rotate, size):
+    """把一张输入变换到布局里的最终尺寸：旋转用 transpose，缩放与对齐合并为一次 resize"""
+    if rotate in TRANSPOSE_FOR_ROTATE: img = img.transpose(TRANSPOSE_FOR_ROTATE[rotate])
+    elif rotate: img = img.rotate(-rotate, expand=True)
+    if img.size != tuple(size): img = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+    return img
+
+@traced('stitch')
+def stitch_images_advanced(images_data, mode='vertical', alignment='max', cols=2, padding=0, bg_color='#FFFFFF', progress=None):
+    """每张输入只做一次重采样：先由原图尺寸算出布局，再把旋转、缩放、对齐合成一次变换"""
+    if not images_data: return None
+    bg_color_rgb = parse_color(bg_color)
+    sizes = [transformed_size(item['img'].size, item['scale'], item['rotate']) for item in images_data]
+    canvas_size, boxes = plan_stitch_layout(sizes, mode, alignment, cols, padding)
+    result = Image.new('RGB', canvas_size, bg_color_rgb)
+    for i, (item, (x, y, w, h)) in enumerate(zip(images_data, boxes)):
+        result.paste(transform_input(item['img'], item['rotate'], (w, h)), (x, y))
+        if progress: progress(i + 1, len(images_data))
+    return result
+
+# === 流式拼接：先按图片头算布局，再逐条带生成输出，内存占用与总尺寸无关 ===
+STREAM_STRIP_HEIGHT = 256
+STREAM_PREVIEW_SIZE = 2000
+
+class StreamedStitch:
+    """流式拼接结果：大图以 PNG 形式落在临时文件里，内存中只保留一张小预览。
+    结果可能被多个会话共享（后台任务复用），临时文件在对象被回收时删除"""
+    def __init__(self, path, size, preview):
+        self.path, self.size, self.preview = path, size, preview
+        self.width, self.height = size
+        self._finalizer = weakref.finalize(self, remove_file, path)
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def discard(self):
+        self._finalizer()
+
+class PNGStreamWriter:
+    """逐行写入 RGB PNG（filter 0 + zlib 流式压缩），不需要整图缓冲"""
+    def __init__(self, fp, width, height, level=6):
+        self.fp, self.stride = fp, width * 3
+        self._z = zlib.compressobj(level)
+        fp.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, tag, data):
+        self.fp.write(struct.pack('>I', len(data)) + tag + data)
+        self.fp.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    def write_rows(self, raw):
+        rows = b''.join(b'\x00' + raw[i:i + self.stride] for i in range(0, len(raw), self.stride))
+        data = self._z.compress(rows)
+        if data: self._chunk(b'IDAT', data)
+
+    def close(self):
+        self._chunk(b'IDAT', self._z.flush())
+        self._chunk(b'IEND', b'')
+
+def _open_source(src):
+    if isinstance(src, (str, os.PathLike)): return Image.open(src)
+    if isinstance(src, bytes): return Image.open(io.BytesIO(src))
+    src.seek(0)
+    return Image.open(src)
+
+def probe_size(src):
+    """只读文件头获取（EXIF 校正后的）尺寸，不解码像素。src 为 Image、路径、字节或文件对象"""
+    if isinstance(src, Image.Image): return src.size
+    try:
+        with _open_source(src) as im:
+            w, h = im.size
+            if hasattr(im, '_getexif') and im.getexif().get(0x0112) in (5, 6, 7, 8): w, h = h, w
+            return w, h
+    except Exception:
+        return (200, 50)
+
+def load_source(src, decoder=decode_image_bytes):
+    """解码拼接输入：已解码的 Image 原样返回，路径、字节或文件对象读出字节后交给 decoder(data)"""
+    if isinstance(src, Image.Image): return src
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, 'rb') as fp: return decoder(fp.read())
+    if isinstance(src, bytes): return decoder(src)
+    src.seek(0)
+    return decoder(src.read())
+
+def item_source(item):
+    """拼接条目的输入：已解码的 img，否则为 file（路径、字节或文件对象）"""
+    return item['img'] if item.get('img') is not None else item['file']
+
+def stitch_layout(images_data, mode='vertical', alignment='max', cols=2, padding=0):
+    """只读图片头计算拼接布局，返回值同 plan_stitch_layout"""
+    sizes = [transformed_size(probe_size(item_source(it)), it['scale'], it['rotate']) for it in images_data]
+    return plan_stitch_layout(sizes, mode, alignment, cols, padding)
+
+@traced('stitch_stream')
+def stitch_images_streaming(images_data, mode='vertical', alignment='max', cols=2, padding=0, bg_color='#FFFFFF',
+                            strip_height=STREAM_STRIP_HEIGHT, preview_size=STREAM_PREVIEW_SIZE, progress=None,
+                            load=load_source, admit=None, png_level=6, directory=None):
+    """低内存拼接：每张输入只在处理时解码一次并写入临时 raw 文件，之后逐条带合成并流式编码为 PNG。
+    load(src) 解码单个输入；admit(what, nbytes) 为每张输入的变换返回内存租约（上下文管理器）；
+    输出 PNG 写在 directory（默认系统临时目录）下"""
+    if not images_data: return None
+    bg_color_rgb = parse_color(bg_color)
+    (W, H), boxes = stitch_layout(images_data, mode, alignment, cols, padding)
+    steps, done = len(images_data) + -(-H // strip_height), 0
+
+    # 第一阶段：逐张解码 -> 一次变换到布局尺寸 -> 落盘，同一时刻只有一张输入在内存里
+    spill = tempfile.TemporaryFile()
+    offsets = []
+    try:
+        for item, (x, y, w, h) in zip(images_data, boxes):
+            img = load(item_source(item))
+            nbytes = image_nbytes(img) + w * h * 3
+            with admit("拼接", nbytes) if admit else contextlib.nullcontext():
+                img = transform_input(img, item['rotate'], (w, h))
+                offsets.append(spill.tell())
+                spill.write(img.tobytes())
+                del img
+            done += 1
+            if progress: progress(done, steps)
+    except BaseException:
+        spill.close()
+        raise
+
+    # 第二阶段：按条带从落盘数据中读取所需行，粘贴后立即编码
+    scale = min(1.0, preview_size / max(W, H))
+    preview = Image.new('RGB', (max(1, int(W * scale)), max(1, int(H * scale))), bg_color_rgb)
+    out = tempfile.NamedTemporaryFile(prefix='stitch_', suffix='.png', dir=directory, delete=False)
+    try:
+        writer = PNGStreamWriter(out, W, H, png_level)
+        for y0 in range(0, H, strip_height):
+            y1 = min(H, y0 + strip_height)
+            strip = Image.new('RGB', (W, y1 - y0), bg_color_rgb)
+            for (x, y, w, h), off in zip(boxes, offsets):
+                r0, r1 = max(y0, y) - y, min(y1, y + h) - y
+                if r0 >= r1: continue
+                spill.seek(off + r0 * w * 3)
+                strip.paste(Image.frombytes('RGB', (w, r1 - r0), spill.read((r1 - r0) * w * 3)), (x, y + r0 - y0))
+            writer.write_rows(strip.tobytes())
+            p0, p1 = int(y0 * scale), int(y1 * scale)
+            if p1 > p0: preview.paste(strip.resize((preview.width, p1 - p0), Image.Resampling.BILINEAR), (0, p0))
+            done += 1
+            if progress: progress(done, steps)
+        writer.close()
+    except BaseException:
+        out.close()
+        os.remove(out.name)
+        raise
+    finally:
+        spill.close()
+    out.close()
+    return StreamedStitch(out.name, (W, H), preview)
+
+def _encode_crop(img, box):
+    try:
+        buf = io.BytesIO()
+        img.crop(box).save(buf, 'PNG')
+        return buf.getvalue()
+    except Exception:
+        return None
+
+@traced('zip')
+def build_crops_zip(img, boxes, names, progress=None, max_workers=None):
+    """在线程池中并行编码各区域为 PNG，按顺序写入 ZIP_STORED 归档（PNG 本身已压缩）。
+    同时在途的编码结果不超过 2 倍线程数，编码失败的区域直接跳过。"""
+    out = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_BYTES)
+    workers = max(1, max_workers or min(8, os.cpu_count() or 1))
+    total = len(boxes)
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as zf, ThreadPoolExecutor(workers) as pool:
+        pending, done = deque(), 0
+        for i, (name, box) in enumerate(zip(names, boxes)):
+            pending.append((name, pool.submit(_encode_crop, img, box)))
+            while pending and (len(pending) >= 2 * workers or i == total - 1):
+                name, fut = pending.popleft()
+                data = fut.result()
+                if data is not None: zf.writestr(name, data)
+                done += 1
+                if progress: progress(done, total)
+    out.seek(0)
+    return out
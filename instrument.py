@@ -0,0 +1,182 @@
+"""轻量耗时埋点：按每次重跑收集 span，累计到进程级统计，可写 JSON Lines / Prometheus 文本。
+
+    with span('tab1'): ...
+    @traced('decode')
+    def decode_image_bytes(...): ...
+
+没有活动的 Recorder 时 span 只有一次 contextvar 查询的开销。线程池里的任务需要在
+线程初始化时调用 bind(recorder)，否则其中的 span 不会被记录。
+"""
+import contextvars
+import functools
+import json
+import threading
+import time
+from collections import defaultdict
+
+_current = contextvars.ContextVar('image_tool_recorder', default=None)
+_log_lock = threading.Lock()
+
+
+class Recorder:
+    """一次重跑内的全部 span：(名称, 开始偏移秒, 耗时秒, 嵌套深度, 属性)"""
+    def __init__(self, label=''):
+        self.label = label
+        self.t0 = time.perf_counter()
+        self.spans = []
+        self.elapsed = None
+        self._depth = threading.local()
+        self._lock = threading.Lock()
+
+    def add(self, name, start, seconds, depth, attrs):
+        with self._lock: self.spans.append((name, start - self.t0, seconds, depth, attrs))
+
+    def totals(self):
+        """按名称汇总：{名称: {'calls', 'seconds', 'bytes'}}"""
+        out = defaultdict(lambda: {'calls': 0, 'seconds': 0.0, 'bytes': 0})
+        with self._lock: spans = list(self.spans)
+        for name, _, seconds, _, attrs in spans:
+            t = out[name]
+            t['calls'] += 1
+            t['seconds'] += seconds
+            t['bytes'] += attrs.get('bytes', 0)
+        return dict(out)
+
+    def to_json(self, **extra):
+        with self._lock: spans = sorted(self.spans, key=lambda sp: sp[1])
+        return dict(extra, label=self.label, seconds=round(self.elapsed or 0, 4), totals=self.totals(),
+                    spans=[dict(attrs, name=n, start=round(s, 4), seconds=round(d, 4), depth=depth) for n, s, d, depth, attrs in spans])
+
+
+class SpanStats:
+    """进程级累计，所有会话共享"""
+    def __init__(self):
+        self._totals = defaultdict(lambda: [0, 0.0, 0])
+        self._lock = threading.Lock()
+
+    def merge(self, recorder):
+        with self._lock:
+            for name, t in recorder.totals().items():
+                acc = self._totals[name]
+                acc[0] += t['calls']
+                acc[1] += t['seconds']
+                acc[2] += t['bytes']
+
+    def prometheus_text(self):
+        with self._lock: items = sorted(self._totals.items())
+        lines = []
+        for index, metric in enumerate(('calls', 'seconds', 'bytes')):
+            lines += prometheus_metric(f"span_{metric}", 'counter', [({'span': name}, acc[index]) for name, acc in items])
+        return "\n".join(lines) + "\n"
+
+
+def prometheus_metric(name, kind, samples):
+    """一个指标的 Prometheus 文本行；samples 为 [(标签字典, 值)]，计数器名加 _total 后缀"""
+    metric = f"image_tool_{name}" + ('_total' if kind == 'counter' else '')
+    lines = [f"# TYPE {metric} {kind}"]
+    for labels, value in samples:
+        label = "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}" if labels else ""
+        lines.append(f"{metric}{label} {value:.6g}" if isinstance(value, float) else f"{metric}{label} {value}")
+    return lines
+
+
+def prometheus_text(prefix, stats, counters):
+    """stats 字典转为 Prometheus 文本：counters 里的名字是计数器，其余是 gauge"""
+    lines = []
+    for name, value in stats.items():
+        lines += prometheus_metric(f"{prefix}_{name}", 'counter' if name in counters else 'gauge', [({}, value)])
+    return "\n".join(lines) + "\n"
+
+
+def rss_kb(field):
+    """/proc/self/status 里的内存字段（VmRSS、VmHWM 等），单位 KB；非 Linux 时为 0"""
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith(field): return int(line.split()[1])
+    except OSError: pass
+    return 0
+
+
+def reset_peak_rss():
+    """重置 VmHWM，使峰值只统计之后的代码（Linux；容器里可能没有写权限）。成功时返回 True"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp: fp.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def start(label=''):
+    """开始一次重跑的记录并设为当前 Recorder"""
+    recorder = Recorder(label)
+    _current.set(recorder)
+    return recorder
+
+
+def finish(recorder, stats=None, log_path=None, **extra):
+    """结束记录：计入进程级统计，并按需追加一行 JSON 到 log_path"""
+    recorder.elapsed = time.perf_counter() - recorder.t0
+    if _current.get() is recorder: _current.set(None)
+    if stats is not None: stats.merge(recorder)
+    if log_path:
+        line = json.dumps(recorder.to_json(time=time.strftime('%Y-%m-%dT%H:%M:%S'), **extra), ensure_ascii=False)
+        with _log_lock, open(log_path, 'a', encoding='utf-8') as fp: fp.write(line + "\n")
+    return recorder
+
+
+def current():
+    return _current.get()
+
+
+def bind(recorder):
+    """在线程池的工作线程里调用，使该线程的 span 记到同一个 Recorder"""
+    _current.set(recorder)
+
+
+def _describe(value, attrs):
+    size = getattr(value, 'size', None)
+    if isinstance(size, tuple) and len(size) == 2: attrs['size'] = list(size)
+    elif isinstance(value, (bytes, bytearray, str)): attrs['bytes'] = len(value)
+    elif isinstance(value, list) and value and hasattr(value[0], 'size'): attrs['count'] = len(value)
+    elif isinstance(getattr(value, 'data', None), bytes): attrs['bytes'] = len(value.data)
+
+
+class span:
+    """计时上下文；attrs 可在 with 块内继续补充（如产出的字节数）"""
+    __slots__ = ('name', 'attrs', '_recorder', '_start', '_depth')
+
+    def __init__(self, name, **attrs):
+        self.name, self.attrs = name, attrs
+
+    def __enter__(self):
+        self._recorder = _current.get()
+        if self._recorder is not None:
+            local = self._recorder._depth
+            self._depth = getattr(local, 'value', 0)
+            local.value = self._depth + 1
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self._recorder is not None:
+            end = time.perf_counter()
+            self._recorder._depth.value = self._depth
+            self._recorder.add(self.name, self._start, end - self._start, self._depth, self.attrs)
+        return False
+
+    def describe(self, value):
+        """把图片尺寸 / 字节数等记入属性，原样返回 value"""
+        if self._recorder is not None: _describe(value, self.attrs)
+        return value
+
+
+def traced(name):
+    """函数级埋点，自动记录返回图片的尺寸或字节数"""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            if _current.get() is None: return fn(*args, **kwargs)
+            with span(name) as s: return s.describe(fn(*args, **kwargs))
+        return inner
+    return wrap
@@ -0,0 +1,114 @@
+"""后台任务：重计算放进共享线程池，按输入生成的 key 去重，支持进度与取消。
+
+同一个 key 的任务只会运行一次：运行中再次提交会挂到已有任务上，完成的任务保留在
+LRU 中供后续重跑直接取结果。取消是协作式的，任务函数在 job.report() 处检查取消标志。
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+_local = threading.local()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, key, label):
+        self.key, self.label = key, label
+        self.status, self.progress, self.message = QUEUED, 0.0, ''
+        self.result = self.error = None
+        self.submitted, self.started, self.finished = time.time(), None, None
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+
+    def report(self, done, total=None, message=None):
+        """进度回调：report(已完成, 总数) 或 report(比例)；请求取消后抛出 JobCancelled"""
+        if self._cancel.is_set(): raise JobCancelled()
+        self.progress = min(1.0, done / total) if total else float(done)
+        if message is not None: self.message = message
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelling(self):
+        return self._cancel.is_set() and self.status in (QUEUED, RUNNING)
+
+    def finished_ok(self):
+        return self.status == DONE
+
+    def active(self):
+        return self.status in (QUEUED, RUNNING)
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def elapsed(self):
+        if self.started is None: return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+def current():
+    """当前线程正在执行的任务，不在任务线程里时为 None"""
+    return getattr(_local, 'job', None)
+
+
+class JobManager:
+    def __init__(self, max_workers=2, keep=16):
+        self.keep = keep
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix='image-job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, key, label, fn, *args, **kwargs):
+        """提交 fn(job, *args, **kwargs)；相同 key 的任务在运行或已成功时直接复用"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and (job.active() or job.finished_ok()):
+                self._jobs.move_to_end(key)
+                return job
+            job = self._jobs[key] = Job(key, label)
+            self._trim()
+        self._pool.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, key):
+        with self._lock: return self._jobs.get(key) if key is not None else None
+
+    def discard(self, key):
+        """丢弃已结束的任务，下次提交会重新计算"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and not job.active(): del self._jobs[key]
+
+    def jobs(self):
+        with self._lock: return list(self._jobs.values())
+
+    def _trim(self):
+        # 只淘汰已结束的任务，运行中的任务不受 keep 限制
+        finished = [k for k, j in self._jobs.items() if not j.active()]
+        for k in finished[:max(0, len(self._jobs) - self.keep)]: del self._jobs[k]
+
+    def _run(self, job, fn, args, kwargs):
+        if job._cancel.is_set():
+            job.status = CANCELLED
+        else:
+            job.status, job.started = RUNNING, time.time()
+            _local.job = job
+            try:
+                job.result = fn(job, *args, **kwargs)
+                job.progress, job.status = 1.0, DONE
+            except JobCancelled:
+                job.status = CANCELLED
+            except Exception as e:
+                # 不保留 traceback，否则栈帧里的大图会跟着任务一起留在 LRU 中
+                job.error, job.status = e.with_traceback(None), FAILED
+            finally:
+                _local.job = None
+        job.finished = time.time()
+        job._done.set()
+        with self._lock: self._trim()
@@ -0,0 +1,208 @@
+"""enhance_image 的 NumPy 融合实现。
+
+PIL 路径里 UnsharpMask / Contrast / Color / Sharpness 每一步都会新建整幅图片，
+ImageEnhance 还会额外构造一幅 degenerate 图，2 倍放大后同时存活约 8 份整图缓冲。
+这里同时最多只有两份整图缓冲，按行条带在 float32 小缓冲上完成全部调整：
+
+- 第一遍：逐条带做 UnsharpMask，结果写入 mid，同时累计 L 通道总和（Contrast 需要全局均值）
+- 第二遍：逐条带做 Contrast -> Color -> Sharpness，结果直接贴进输出图
+
+各步骤按 Pillow 的 C 实现复现（定点 box blur、blend 截断取整、L 的定点系数、
+SMOOTH 的累加顺序），在常见编译条件下结果与 PIL 路径逐像素一致；
+若 Pillow 编译时启用了 FMA 等浮点收缩，blend 处可能出现 ±1 的差异。
+
+    python numpy_enhance.py 2000x1500 4000x3000
+
+对比两种引擎的耗时、峰值内存和像素误差。
+"""
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFilter
+
+from instrument import reset_peak_rss, rss_kb
+
+BAND_ROWS = 64
+TOLERANCE = 1  # 与 PIL 路径允许的最大逐像素误差（见上文 FMA 说明）
+UNSHARP_RADIUS, UNSHARP_PERCENT, UNSHARP_THRESHOLD = 2.0, 150, 3
+BLUR_PASSES = 3
+SMOOTH_KERNEL = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / np.float32(13)
+
+
+def _box_radius(radius, passes=BLUR_PASSES):
+    """与 Pillow _gaussian_blur_radius 相同：把高斯半径换算为扩展 box blur 半径"""
+    sigma2 = radius * radius / passes
+    L = np.sqrt(12.0 * sigma2 + 1.0)
+    l = np.floor((L - 1.0) / 2.0)
+    a = (2 * l + 1) * (l * (l + 1) - 3 * sigma2) / (6 * (sigma2 - (l + 1) * (l + 1)))
+    return float(np.float32(l + a))
+
+
+def _box_pass(arr, radius, axis):
+    """沿 axis 做一次定点 box blur（边缘按最近像素延伸），与 C 实现一样用 uint32 累加不会溢出"""
+    r = int(radius)
+    ww = np.uint32((1 << 24) / np.float32(radius * 2 + 1))
+    fw = np.uint32(((1 << 24) - (r * 2 + 1) * int(ww)) // 2)
+    pad = [(0, 0)] * arr.ndim
+    pad[axis] = (r + 1, r + 1)
+    p = np.pad(arr, pad, mode='edge')
+    n = arr.shape[axis]
+    def view(i):
+        index = [slice(None)] * arr.ndim
+        index[axis] = slice(i, i + n)
+        return p[tuple(index)]
+    acc = view(1).copy()
+    for i in range(2, 2 * r + 2): acc += view(i)
+    acc *= ww
+    edge = view(0) + view(2 * r + 2)
+    edge *= fw
+    acc += edge
+    acc += np.uint32(1 << 23)
+    acc >>= np.uint32(24)
+    return acc
+
+
+def _rows(arr, y0, y1):
+    """取 [y0, y1) 行，越界部分按边缘复制"""
+    return arr[np.clip(np.arange(y0, y1), 0, arr.shape[0] - 1)]
+
+
+def _luma(band):
+    # 与 Pillow RGB -> L 相同的定点系数
+    b = band.astype(np.uint32)
+    return (b[..., 0] * 19595 + b[..., 1] * 38470 + b[..., 2] * 7471 + 0x8000) >> 16
+
+
+def _blend_into(out, base, factor):
+    """out = clip(trunc(base + factor * (out - base)))，与 Image.blend 一致，原地计算"""
+    out -= base
+    out *= factor
+    out += base
+    np.clip(out, 0, 255, out=out)
+    np.floor(out, out=out)
+
+
+def _unsharp_band(src, y0, y1, radius):
+    h = src.shape[0]
+    halo = BLUR_PASSES * (int(radius) + 1)
+    ys = np.arange(y0 - halo, y1 + halo)
+    top, bottom = ys < 0, ys > h - 1
+    blurred = _rows(src, y0 - halo, y1 + halo).astype(np.uint32)
+    for _ in range(BLUR_PASSES): blurred = _box_pass(blurred, radius, axis=1)
+    for _ in range(BLUR_PASSES):
+        blurred = _box_pass(blurred, radius, axis=0)
+        # Pillow 每一遍都把越界行钳到图像边缘，这里同步覆盖越界行
+        if top.any(): blurred[top] = blurred[np.argmin(top)]
+        if bottom.any(): blurred[bottom] = blurred[np.argmax(bottom) - 1]
+    center = src[y0:y1].astype(np.int16)
+    diff = center - blurred[halo:halo + y1 - y0].astype(np.int16)
+    del blurred
+    # C 的整数除法向零截断
+    sharpened = np.clip(center + np.sign(diff) * (np.abs(diff) * np.int16(UNSHARP_PERCENT) // 100), 0, 255)
+    return np.where(np.abs(diff) > UNSHARP_THRESHOLD, sharpened, center).astype(np.uint8)
+
+
+def _adjust_band(src, y0, y1, mean, sharpness, contrast, color):
+    h = src.shape[0]
+    a0, a1 = max(0, y0 - 1), min(h, y1 + 1)
+    band = src[a0:a1].astype(np.float32)
+    _blend_into(band, np.float32(mean), contrast)
+    gray = _luma(band)[..., None].astype(np.float32)
+    _blend_into(band, gray, color)
+    del gray
+    # SMOOTH 与 Pillow 一样保留图像最外一圈像素不变
+    smooth = band.copy()
+    # 与 Filter.c 相同的累加顺序与 +0.5 截断取整
+    inner = np.full_like(band[1:-1, 1:-1], 0.5)
+    rows, cols = band.shape[0] - 2, band.shape[1] - 2
+    for dy in (2, 1, 0):
+        k = SMOOTH_KERNEL[2 - dy]
+        inner += band[dy:dy + rows, 0:cols] * k[0] + band[dy:dy + rows, 1:1 + cols] * k[1] + band[dy:dy + rows, 2:2 + cols] * k[2]
+    np.clip(inner, 0, 255, out=inner)
+    smooth[1:-1, 1:-1] = np.floor(inner)
+    del inner
+    if a0 == 0: smooth[0] = band[0]
+    if a1 == h: smooth[-1] = band[-1]
+    _blend_into(band, smooth, sharpness)
+    return band[y0 - a0:y1 - a0].astype(np.uint8)
+
+
+def enhance_numpy(image, upscale_factor=2.0, sharpness=2.0, contrast=1.1, color=1.1, band_rows=BAND_ROWS, progress=None):
+    if image.mode != 'RGB': image = image.convert('RGB')
+    if upscale_factor > 1.0:
+        new_w, new_h = int(image.width * upscale_factor), int(image.height * upscale_factor)
+        image = image.resize((new_w, new_h), Image.Resampling.LANCZOS)
+    size = image.size
+    h = size[1]
+    # 分条带转换，避免 tobytes() 拼接整图时的临时双份拷贝
+    up = np.empty((h, size[0], 3), dtype=np.uint8)
+    for y0 in range(0, h, band_rows): up[y0:y0 + band_rows] = np.asarray(image.crop((0, y0, size[0], min(h, y0 + band_rows))))
+    del image
+    radius = _box_radius(UNSHARP_RADIUS)
+    bands = 2 * -(-h // band_rows)
+    mid = np.empty_like(up)
+    luma_sum = 0
+    for y0 in range(0, h, band_rows):
+        y1 = min(h, y0 + band_rows)
+        mid[y0:y1] = _unsharp_band(up, y0, y1, radius)
+        luma_sum += int(_luma(mid[y0:y1]).sum())
+        if progress: progress(y0 // band_rows + 1, bands)
+    del up
+    mean = int(luma_sum / (size[0] * size[1]) + 0.5)
+    # 第二遍的条带直接贴进结果图，不再经过整图 ndarray
+    result = Image.new('RGB', size)
+    for y0 in range(0, h, band_rows):
+        y1 = min(h, y0 + band_rows)
+        result.paste(Image.fromarray(_adjust_band(mid, y0, y1, mean, sharpness, contrast, color), 'RGB'), (0, y0))
+        if progress: progress(bands // 2 + y0 // band_rows + 1, bands)
+    return result
+
+
+def _pil_reference(image, upscale_factor=2.0, sharpness=2.0, contrast=1.1, color=1.1):
+    # 与 image_core.enhance_image 的单次 PIL 路径相同
+    if upscale_factor > 1.0:
+        img = image.resize((int(image.width * upscale_factor), int(image.height * upscale_factor)), Image.Resampling.LANCZOS)
+    else: img = image.copy()
+    img = img.filter(ImageFilter.UnsharpMask(radius=2, percent=150, threshold=3))
+    img = ImageEnhance.Contrast(img).enhance(contrast)
+    img = ImageEnhance.Color(img).enhance(color)
+    return ImageEnhance.Sharpness(img).enhance(sharpness)
+
+
+def _measure(engine, size, queue):
+    src = Image.effect_noise(size, 40).convert('RGB').filter(ImageFilter.GaussianBlur(1))
+    can_reset = reset_peak_rss()
+    base = rss_kb('VmRSS')
+    t = time.perf_counter()
+    out = (enhance_numpy if engine == 'numpy' else _pil_reference)(src)
+    elapsed = time.perf_counter() - t
+    peak_mb = (rss_kb('VmHWM') - base) / 1024 if can_reset else None
+    queue.put((elapsed, peak_mb, out.tobytes()))
+
+
+def compare(size):
+    """在独立子进程中分别运行两种引擎，返回 (时间, 峰值内存 MB) 及误差统计；无法重置峰值时内存为 None"""
+    import multiprocessing
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for engine in ('pil', 'numpy'):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_measure, args=(engine, size, queue))
+        proc.start()
+        results[engine] = queue.get()
+        proc.join()
+    a = np.frombuffer(results['pil'][2], np.uint8).astype(np.int16)
+    b = np.frombuffer(results['numpy'][2], np.uint8).astype(np.int16)
+    diff = np.abs(a - b)
+    return {e: results[e][:2] for e in results}, float(diff.mean()), int(np.percentile(diff, 99.9)), int(diff.max())
+
+
+if __name__ == '__main__':
+    sizes = [tuple(map(int, s.split('x'))) for s in sys.argv[1:]] or [(1000, 750), (2000, 1500), (4000, 3000)]
+    print(f"{'input':>11} {'pil s':>7} {'numpy s':>8} {'pil MB':>8} {'numpy MB':>9} {'mean|d|':>8} {'p99.9':>6} {'max':>4}")
+    for size in sizes:
+        r, mean_diff, p999, max_diff = compare(size)
+        mb = {e: f"{r[e][1]:.0f}" if r[e][1] is not None else '-' for e in r}
+        print(f"{size[0]:>5}x{size[1]:<5} {r['pil'][0]:>7.2f} {r['numpy'][0]:>8.2f} {mb['pil']:>8} {mb['numpy']:>9} "
+              f"{mean_diff:>8.3f} {p999:>6} {max_diff:>4}")
@@ -0,0 +1,139 @@
+"""会话结果落盘：拼接 / 修复结果以 raw 像素文件保存，内存里只留预览，整图在导出或放大时才读回。
+"""
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from PIL import Image
+
+from image_core import image_nbytes, remove_file
+from instrument import prometheus_text, span
+
+PREVIEW_SIZE = 1600
+WRITE_ROWS = 512
+
+
+def _fit(size, max_side):
+    ratio = min(1.0, max_side / max(size))
+    return max(1, int(size[0] * ratio)), max(1, int(size[1] * ratio))
+
+
+def _resize(img, size):
+    return img.resize(size)
+
+
+class StoredImage:
+    """落盘的结果图。width/height/size/mode 与 Image 一致，view() 取预览，image() 读回整图"""
+    def __init__(self, store, key, path, mode, size, preview):
+        self.store, self.key, self.path, self.mode, self.size, self.preview = store, key, path, mode, size, preview
+        self.width, self.height = size
+        self.nbytes = size[0] * size[1] * Image.getmodebands(mode)
+        self.last_used = time.time()
+        self.expired = False
+        self._full = None
+
+    def image(self):
+        """通过 mmap 读回整图；同一时刻被持有的整图只读一次"""
+        img = self._full() if self._full else None
+        if img is not None: return img
+        self.store.touch(self)
+        with span('result_load', bytes=self.nbytes), open(self.path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            img = Image.frombytes(self.mode, self.size, mm)
+        self._full = weakref.ref(img)
+        return img
+
+    def view(self, size):
+        """缩放到 size 的预览；内存中的预览不够大时才读回整图"""
+        self.store.touch(self)
+        base = self.preview if self.preview.width >= size[0] and self.preview.height >= size[1] else self.image()
+        return self.store.resize(base, size)
+
+
+class SessionResultStore:
+    """进程级结果存储：相同 key（后台任务 key）的结果只落盘一次，多个会话共享同一个 StoredImage。
+    按最近查看时间做全局 LRU（磁盘字节数上限）和 TTL 淘汰，淘汰后 StoredImage.expired 为 True。
+    assign() 记录会话引用了哪些结果，用于统计每个会话的占用；resize(img, size) 用于生成和缩放预览。"""
+    def __init__(self, directory, max_bytes, ttl, resize=_resize):
+        self.dir = tempfile.mkdtemp(prefix='image_tool_results_', dir=directory)
+        self.max_bytes, self.ttl, self.resize = max_bytes, ttl, resize
+        self.bytes = 0
+        self._entries = OrderedDict()   # key -> StoredImage
+        self._sessions = {}             # (session_id, name) -> StoredImage
+        self._lock = threading.Lock()
+        self.counters = {'writes': 0, 'evictions': 0, 'expirations': 0}
+        weakref.finalize(self, shutil.rmtree, self.dir, True)
+
+    def get(self, key):
+        with self._lock: hit = self._entries.get(key)
+        return hit if hit is not None and not hit.expired else None
+
+    def put(self, key, img):
+        hit = self.get(key)
+        if hit is not None: return hit
+        if img.mode not in ('RGB', 'RGBA', 'L', 'LA'): img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        path = os.path.join(self.dir, f"{hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()}.raw")
+        with span('result_spill') as sp, open(path + '.tmp', 'wb') as fp:
+            # 按行条带写入，避免 tobytes() 的整图临时拷贝
+            for y0 in range(0, img.height, WRITE_ROWS): fp.write(img.crop((0, y0, img.width, min(img.height, y0 + WRITE_ROWS))).tobytes())
+            sp.attrs['bytes'] = fp.tell()
+        os.replace(path + '.tmp', path)
+        stored = StoredImage(self, key, path, img.mode, img.size, img if max(img.size) <= PREVIEW_SIZE
+                             else self.resize(img, _fit(img.size, PREVIEW_SIZE)))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None: self._drop(old)
+            self._entries[key] = stored
+            self.bytes += stored.nbytes
+            self.counters['writes'] += 1
+        self.evict()
+        return stored
+
+    def touch(self, stored):
+        with self._lock:
+            stored.last_used = time.time()
+            if self._entries.get(stored.key) is stored: self._entries.move_to_end(stored.key)
+
+    def assign(self, session_id, name, value):
+        with self._lock:
+            if isinstance(value, StoredImage): self._sessions[(session_id, name)] = value
+            else: self._sessions.pop((session_id, name), None)
+
+    def _drop(self, stored):
+        stored.expired = True
+        self.bytes -= stored.nbytes
+        remove_file(stored.path)
+        for k in [k for k, v in self._sessions.items() if v is stored]: del self._sessions[k]
+
+    def evict(self):
+        now = time.time()
+        with self._lock:
+            while self._entries:
+                key, oldest = next(iter(self._entries.items()))
+                if now - oldest.last_used > self.ttl: self.counters['expirations'] += 1
+                elif self.bytes > self.max_bytes and len(self._entries) > 1: self.counters['evictions'] += 1
+                else: break
+                del self._entries[key]
+                self._drop(oldest)
+
+    def footprint(self, session_id=None):
+        """{'entries', 'disk_bytes', 'memory_bytes'}，session_id 为空时统计全部结果"""
+        with self._lock:
+            items = list(self._entries.values()) if session_id is None else \
+                list({id(v): v for (sid, _), v in self._sessions.items() if sid == session_id}.values())
+        return {'entries': len(items), 'disk_bytes': sum(v.nbytes for v in items),
+                'memory_bytes': sum(image_nbytes(v.preview) for v in items)}
+
+    def stats(self):
+        with self._lock: sessions = len({sid for sid, _ in self._sessions})
+        total = self.footprint()
+        return dict(self.counters, entries=total['entries'], disk_bytes=total['disk_bytes'], memory_bytes=total['memory_bytes'],
+                    sessions=sessions, max_bytes=self.max_bytes)
+
+    def prometheus_text(self):
+        return prometheus_text('result_store', self.stats(), self.counters)
@@ -0,0 +1,35 @@
+"""NumPy 引擎与 PIL 路径的误差测试：逐像素误差不超过 numpy_enhance.TOLERANCE"""
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+
+import image_core
+import numpy_enhance
+
+
+def _source(size, seed):
+    rng = np.random.default_rng(seed)
+    img = Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), np.uint8))
+    # 模糊后有 USM 阈值以下的平滑区域，未模糊的图覆盖大量边缘像素
+    return img.filter(ImageFilter.GaussianBlur(1)) if seed % 2 else img
+
+
+@pytest.mark.parametrize('upscale', [1.0, 2.0, 1.5])
+@pytest.mark.parametrize('params', [(2.0, 1.1, 1.1), (0.0, 0.5, 1.0), (5.0, 2.0, 1.3)])
+@pytest.mark.parametrize('size,seed', [((97, 61), 1), ((64, 130), 2)])
+def test_matches_pil_within_tolerance(upscale, params, size, seed):
+    src = _source(size, seed)
+    sharpness, contrast, color = params
+    expected = image_core.enhance_image(src, upscale, sharpness, contrast, color, tiled=False, engine='pil')
+    actual = image_core.enhance_image(src, upscale, sharpness, contrast, color, engine='numpy')
+    assert actual.size == expected.size and actual.mode == expected.mode
+    diff = np.abs(np.asarray(actual, np.int16) - np.asarray(expected, np.int16))
+    assert diff.max() <= numpy_enhance.TOLERANCE
+
+
+def test_small_band_rows_match_single_band():
+    # 条带边界处的 blur / smooth 需要上下文行，条带高度不应影响结果
+    src = _source((50, 70), 1)
+    whole = numpy_enhance.enhance_numpy(src, 1.5, band_rows=1000)
+    banded = numpy_enhance.enhance_numpy(src, 1.5, band_rows=7)
+    assert np.array_equal(np.asarray(whole), np.asarray(banded))